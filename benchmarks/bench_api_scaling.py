@@ -0,0 +1,127 @@
+"""Measure read-only API throughput as pre-fork API workers are added.
+
+Starts the proxy in a subprocess for each worker count, seeds it through the thermostat protocol port,
+then drives the API port with keep-alive clients in separate processes.
+
+Run from the repository root:  python -m benchmarks.bench_api_scaling --workers 1 2 4
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+import http.client
+import urllib.parse
+import multiprocessing
+
+from benchmarks.fixtures import SYSTEM_XML, STATUS_XML
+
+API_PATHS = ["/api/status.json", "/api/config/zones/1", "/api/config/zones/1/activities/home/htsp", "/api/system.xml"]
+
+
+def getFreePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitForPort(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Proxy did not start listening on port {}".format(port))
+
+
+def postForm(port, path, data):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request("POST", path, urllib.parse.urlencode({"data": data}), {"Content-Type": "application/x-www-form-urlencoded"})
+    connection.getresponse().read()
+    connection.close()
+
+
+def runClient(port, duration, results):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    count = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        connection.request("GET", API_PATHS[count % len(API_PATHS)])
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError("Unexpected status {}".format(response.status))
+        count += 1
+    results.put(count)
+
+
+def measure(workers, clients, duration):
+    with tempfile.TemporaryDirectory(prefix="infinity-bench-") as stateDir:
+        return measureIn(stateDir, workers, clients, duration)
+
+
+def measureIn(stateDir, workers, clients, duration):
+    port, apiPort = getFreePort(), getFreePort()
+    command = [sys.executable, "-c",
+               "from infinitytouch.infinityproxy import InfinityProxy; "
+               "InfinityProxy(port={}, apiPort={}, apiWorkers={}, stateDir={!r}, logLevel='WARNING')".format(port, apiPort, workers, stateDir)]
+    # The proxy and its forked workers get their own process group, so they can all be stopped together
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        waitForPort(port)
+        waitForPort(apiPort)
+        postForm(port, "/systems/BENCH", SYSTEM_XML)
+        postForm(port, "/systems/BENCH/status", STATUS_XML)
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=runClient, args=(apiPort, duration, results)) for _ in range(clients)]
+        for process in processes:
+            process.start()
+        total = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return total / duration
+    finally:
+        stopProcessGroup(proxy)
+
+
+def stopProcessGroup(process, timeout=10):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=os.cpu_count() or 4, help="concurrent client processes")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to run each measurement")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    baseline = None
+    for workers in args.workers:
+        throughput = measure(workers, args.clients, args.duration)
+        baseline = baseline or throughput
+        results[workers] = throughput
+        print("{:>2} API workers: {:>9.0f} requests/s  ({:.2f}x)".format(workers, throughput, throughput / baseline))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"clients": args.clients, "duration": args.duration, "throughput": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
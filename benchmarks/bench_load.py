@@ -0,0 +1,170 @@
+"""Load test the proxy with simulated thermostats and concurrent API clients, reporting latency, throughput and memory per route.
+
+The proxy, the thermostats and the API clients share one process and IOLoop, and only talk over the
+loopback interface, so the results are reproducible on one machine but include the cost of the clients.
+Results are saved as JSON named after the current commit, and can be compared against an earlier run.
+
+Run from the repository root:  python -m benchmarks.bench_load --duration 10
+Compare with an earlier commit:  python -m benchmarks.bench_load --compare benchmarks/results/<commit>.json
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import resource
+import subprocess
+import tracemalloc
+
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+
+from infinitytouch.infinityproxy import createApp
+from benchmarks.simulator import LatencyRecorder, ThermostatSimulator, ApiClient, API_PATHS
+from benchmarks.fixtures import SYSTEM_XML, NOTIFICATION_XML, buildStatusXml
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+MEMORY_SAMPLES = 20
+
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def measureMemory(baseUrl, systemID):
+    """Return the peak bytes traced while serving each kind of request, one at a time."""
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+    simulator = ThermostatSimulator(baseUrl, systemID, LatencyRecorder())
+    requests = [("GET " + path.format("<id>"), lambda path=path: client.fetch(baseUrl + path.format(systemID))) for path in API_PATHS]
+    requests += [
+        ("POST /systems/<id>/status", lambda: simulator.post("", "/status", buildStatusXml())),
+        ("GET /systems/<id>/config", lambda: client.fetch(simulator.getUrl("/config"))),
+        ("POST /systems/<id>/notifications", lambda: simulator.post("", "/notifications", NOTIFICATION_XML)),
+        ("POST /systems/<id>", lambda: simulator.post("", "", SYSTEM_XML)),
+        ("POST /systems/<id>/history", lambda: simulator.post("", "/history", simulator.historyXml))
+    ]
+    peaks = {}
+    tracemalloc.start()
+    try:
+        for route, request in requests:
+            await request()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            for _ in range(MEMORY_SAMPLES):
+                await request()
+            peaks[route] = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+        client.close()
+        simulator.client.close()
+    return peaks
+
+
+async def runLoad(args):
+    # The state writer may still be saving in the background when the directory is removed
+    with tempfile.TemporaryDirectory(prefix="infinity-load-", ignore_cleanup_errors=True) as stateDir:
+        return await runLoadIn(stateDir, args)
+
+
+async def runLoadIn(stateDir, args):
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(createApp(stateDir=stateDir))
+    server.add_sockets(sockets)
+    baseUrl = "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+
+    recorder = LatencyRecorder()
+    systemIDs = ["SIM{:03d}".format(index) for index in range(args.thermostats)]
+    thermostats = [ThermostatSimulator(baseUrl, systemID, recorder, args.status_interval, args.upload_interval, args.history_entries)
+                   for systemID in systemIDs]
+    clients = [ApiClient(baseUrl, systemIDs, recorder, args.edit_rate, not args.no_etags) for _ in range(args.api_clients)]
+    for thermostat in thermostats:
+        await thermostat.seed()
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    await asyncio.gather(*(thermostat.run(deadline) for thermostat in thermostats), *(client.run(deadline) for client in clients))
+    routes = recorder.summarize(time.monotonic() - start)
+
+    if not args.skip_memory:
+        for route, peak in (await measureMemory(baseUrl, systemIDs[0])).items():
+            routes.setdefault(route, {})["peak_alloc_bytes"] = peak
+    server.stop()
+    return routes
+
+
+def printResults(results, baseline=None):
+    print("{:<52} {:>8} {:>9} {:>9} {:>9} {:>7} {:>11}".format("route", "requests", "req/s", "p50 ms", "p99 ms", "errors", "peak alloc"))
+    for route, stats in sorted(results["routes"].items()):
+        print("{:<52} {:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>7} {:>11}".format(
+            route, stats.get("count", 0), stats.get("throughput", 0), stats.get("p50_ms", 0), stats.get("p99_ms", 0),
+            stats.get("errors", 0), stats.get("peak_alloc_bytes", "")))
+        previous = (baseline or {}).get("routes", {}).get(route)
+        if previous and previous.get("count") and stats.get("count"):
+            print("{:<52} {:>8} {:>9} {:>9} {:>9}".format(
+                "  vs {}".format(baseline["commit"]), "",
+                formatChange(stats["throughput"], previous["throughput"]),
+                formatChange(stats["p50_ms"], previous["p50_ms"]),
+                formatChange(stats["p99_ms"], previous["p99_ms"])))
+    print("max RSS {:.1f} MiB".format(results["maxRssKiB"] / 1024))
+
+
+def formatChange(value, previous):
+    if not previous:
+        return "-"
+    return "{:+.0f}%".format((value / previous - 1) * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--thermostats", type=int, default=4, help="simulated thermostats, each with its own system ID")
+    parser.add_argument("--status-interval", type=float, default=0.5, help="seconds between status pings of each thermostat")
+    parser.add_argument("--upload-interval", type=float, default=5.0, help="seconds between config and history uploads of each thermostat")
+    parser.add_argument("--history-entries", type=int, default=500, help="events in each history upload")
+    parser.add_argument("--api-clients", type=int, default=4, help="concurrent API clients")
+    parser.add_argument("--edit-rate", type=float, default=0.02, help="fraction of API requests that change a setpoint")
+    parser.add_argument("--no-etags", action="store_true", help="make API clients fetch full responses instead of revalidating")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run the load")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING", help="log level of the proxy")
+    parser.add_argument("--skip-memory", action="store_true", help="skip the per-route allocation measurement")
+    parser.add_argument("--output", help="file to save the results to, instead of benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger("InfinityProxy").setLevel(args.log_level)
+    routes = asyncio.run(runLoad(args))
+    results = {
+        "commit": getCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "log_level")},
+        "maxRssKiB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "routes": routes
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != results["settings"]:
+            print("Warning: the runs being compared used different settings", file=sys.stderr)
+    printResults(results, baseline)
+
+    outputPath = args.output or os.path.join(RESULTS_DIRECTORY, "{}.json".format(results["commit"]))
+    os.makedirs(os.path.dirname(os.path.abspath(outputPath)), exist_ok=True)
+    with open(outputPath, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results saved to {}".format(outputPath))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Measure how long a restarted proxy takes to import, to start listening and to answer its first requests.
+
+Each run starts the proxy in a fresh interpreter on a state directory seeded with several systems, and
+polls until the thermostat's status ping and an API read succeed.  The proxy is started through the
+InfinityProxy constructor, so the same script can measure older commits for comparison.
+
+Run from the repository root:  python -m benchmarks.bench_startup --systems 4 --runs 5
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import statistics
+import tempfile
+import subprocess
+import http.client
+import urllib.parse
+
+from benchmarks.fixtures import SYSTEM_XML, STATUS_XML
+from benchmarks.bench_api_scaling import getFreePort
+
+
+def seedState(stateDir, systems):
+    for index in range(systems):
+        systemDirectory = os.path.join(stateDir, "SYS{:03d}".format(index))
+        os.makedirs(systemDirectory, exist_ok=True)
+        for fileName, data in (("system.xml", SYSTEM_XML), ("status.xml", STATUS_XML)):
+            with open(os.path.join(systemDirectory, fileName), "wb") as f:
+                f.write(data)
+
+
+def measureImport():
+    command = [sys.executable, "-c", "import time; t = time.perf_counter(); import infinitytouch.infinityproxy; print(time.perf_counter() - t)"]
+    return float(subprocess.run(command, capture_output=True, text=True, check=True).stdout)
+
+
+def request(port, method, path, body=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        headers = {"Content-Type": "application/x-www-form-urlencoded"} if body is not None else {}
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def measureStartup(stateDir, timeout=30):
+    """Return the seconds until the proxy accepts a connection, and until it has answered a status ping and an API read."""
+    port = getFreePort()
+    command = [sys.executable, "-c",
+               "from infinitytouch.infinityproxy import InfinityProxy; "
+               "InfinityProxy(port={}, stateDir={!r}, logLevel='WARNING')".format(port, stateDir)]
+    started = time.perf_counter()
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                break
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise RuntimeError("Proxy did not start listening")
+                time.sleep(0.002)
+        listening = time.perf_counter() - started
+        if request(port, "POST", "/systems/SYS000/status", urllib.parse.urlencode({"data": STATUS_XML})) != 200:
+            raise RuntimeError("Status ping failed")
+        if request(port, "GET", "/api/SYS000/config/zones/1") != 200:
+            raise RuntimeError("API read failed")
+        return listening, time.perf_counter() - started
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--systems", type=int, default=4, help="systems in the seeded state directory")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    imports = [measureImport() for _ in range(args.runs)]
+    with tempfile.TemporaryDirectory(prefix="infinity-startup-") as stateDir:
+        seedState(stateDir, args.systems)
+        listening, served = zip(*(measureStartup(stateDir) for _ in range(args.runs)))
+    results = {
+        "import_ms": statistics.median(imports) * 1e3,
+        "listening_ms": statistics.median(listening) * 1e3,
+        "first_requests_ms": statistics.median(served) * 1e3
+    }
+    print("import {import_ms:.0f} ms, listening after {listening_ms:.0f} ms, first ping and API read answered after {first_requests_ms:.0f} ms"
+          " (medians of {runs} runs with {systems} systems)".format(runs=args.runs, systems=args.systems, **results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(results, systems=args.systems, runs=args.runs), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
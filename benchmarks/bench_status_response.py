@@ -0,0 +1,55 @@
+"""Compare building the thermostat status response from sampleXML against rendering the precompiled template.
+
+Run from the repository root:  python -m benchmarks.bench_status_response
+"""
+
+import argparse
+import datetime
+import timeit
+import tracemalloc
+
+from infinitytouch.infinityproxy import StatusUpdateHandler, getStatusResponseTemplate, formatOutgoingXml
+
+
+def buildFromSample(systemID, elementTextUpdates):
+    return formatOutgoingXml(StatusUpdateHandler.generateResponseXml(systemID, elementTextUpdates))
+
+
+def renderTemplate(systemID, elementTextUpdates):
+    return getStatusResponseTemplate(systemID).render(elementTextUpdates)
+
+
+def measureAllocations(func, *args):
+    tracemalloc.start()
+    func(*args)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="responses to build per repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    systemID = "4123X567890"
+    elementTextUpdates = {
+        "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "serverHasChanges": "true",
+        "configHasChanges": "true"
+    }
+    if buildFromSample(systemID, elementTextUpdates) != renderTemplate(systemID, elementTextUpdates):
+        raise SystemExit("Template output does not match the sampleXML response")
+
+    results = {}
+    for name, func in (("sampleXML", buildFromSample), ("template", renderTemplate)):
+        timings = timeit.repeat(lambda: func(systemID, elementTextUpdates), number=args.number, repeat=args.repeat)
+        results[name] = min(timings) / args.number
+        print("{:<10} {:>8.2f} us/response  peak {:>6} bytes allocated".format(
+            name, results[name] * 1e6, measureAllocations(func, systemID, elementTextUpdates)))
+    print("speedup    {:>8.1f}x".format(results["sampleXML"] / results["template"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Representative thermostat payloads for the benchmarks, shaped like those sent by an 8-zone Infinity system."""
+
+ACTIVITIES = ["home", "away", "sleep", "wake", "manual"]
+DAYS = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
+ZONES = range(1, 9)
+
+
+def buildSystemXml(zoneCount=8):
+    zones = []
+    for zoneID in range(1, zoneCount + 1):
+        activities = "".join(
+            "<activity id=\"{}\"><htsp>{}.0</htsp><clsp>{}.0</clsp><fan>off</fan></activity>".format(activity, 66 + index, 76 - index)
+            for index, activity in enumerate(ACTIVITIES))
+        days = "".join(
+            "<day id=\"{}\">{}</day>".format(day, "".join(
+                "<period id=\"{}\"><activity>{}</activity><time>{:02d}:00</time><enabled>on</enabled></period>".format(period, ACTIVITIES[period % 4], 4 * period + 2)
+                for period in range(1, 6)))
+            for day in DAYS)
+        zones.append(
+            "<zone id=\"{0}\"><name>ZONE {0}</name><enabled>{1}</enabled><hold>off</hold><holdActivity/><otmr/>"
+            "<occEnabled>off</occEnabled><activities>{2}</activities><program>{3}</program></zone>".format(zoneID, "on" if zoneID <= 2 else "off", activities, days))
+    return (
+        "<system version=\"1.7\"><config><mode>auto</mode><cfgem>F</cfgem><cfgtype>heatcool</cfgtype>"
+        "<vacat>off</vacat><vacmint>60.0</vacmint><vacmaxt>84.0</vacmaxt><vacfan>off</vacfan>"
+        "<fueltype>gas</fueltype><gasunit>therm</gasunit><filtertype>media</filtertype><filterinterval>365</filterinterval>"
+        "<humidityVacation><rclgovercool>off</rclgovercool></humidityVacation>"
+        "<zones>{}</zones>"
+        "<wholeHouse><activities>{}</activities></wholeHouse></config></system>".format(
+            "".join(zones),
+            "".join("<activity id=\"{}\"><htsp>60.0</htsp><clsp>80.0</clsp></activity>".format(activity) for activity in ("away", "vacation")))
+    ).encode()
+
+
+def buildStatusXml(zoneCount=8, step=0):
+    zones = "".join(
+        "<zone id=\"{0}\"><name>ZONE {0}</name><enabled>{1}</enabled><currentActivity>home</currentActivity>"
+        "<rt>{2:.1f}</rt><rh>{3}</rh><fan>off</fan><hold>off</hold><htsp>68.0</htsp><clsp>74.0</clsp>"
+        "<damperposition>15</damperposition><occupancy>occupied</occupancy></zone>".format(
+            zoneID, "on" if zoneID <= 2 else "off", 66.0 + ((step + zoneID) % 20) / 10, 38 + (step + zoneID) % 5)
+        for zoneID in range(1, zoneCount + 1))
+    return (
+        "<status version=\"1.37\"><localTime>2018-01-01T10:{:02d}:00</localTime><oat>{}</oat><mode>heat</mode>"
+        "<cfgem>F</cfgem><vacatrunning>off</vacatrunning><filtrlvl>42</filtrlvl><humlvl>100</humlvl><ventlvl>0</ventlvl>"
+        "<humid>off</humid><unocc>off</unocc>"
+        "<idu><type>furnace2stg</type><opstat>{}</opstat><cfm>{}</cfm><statpress>0.31</statpress><blwrpm>600</blwrpm></idu>"
+        "<odu><type>ac2stg</type><opstat>off</opstat><iducfm>0</iducfm></odu>"
+        "<zones>{}</zones></status>".format(step % 60, 40 + step % 10, "low" if step % 3 else "off", 800 if step % 3 else 0, zones)
+    ).encode()
+
+
+def buildNotificationXml(code="200"):
+    return (
+        "<notifications><notification><type>config</type><code>{}</code><message>Config received</message>"
+        "<timestamp>2018-01-01T10:00:00Z</timestamp><changes><change id=\"1\">zone 1 htsp</change></changes>"
+        "</notification></notifications>".format(code)
+    ).encode()
+
+
+def buildHistoryXml(entries=500):
+    return (
+        "<history version=\"1.37\">{}</history>".format("".join(
+            "<event id=\"{0}\"><timestamp>2018-01-01T{1:02d}:{2:02d}:00</timestamp><type>stage</type><value>{3}</value></event>".format(
+                index, (index // 60) % 24, index % 60, index % 3)
+            for index in range(entries)))
+    ).encode()
+
+
+SYSTEM_XML = buildSystemXml()
+STATUS_XML = buildStatusXml()
+NOTIFICATION_XML = buildNotificationXml()
+HISTORY_XML = buildHistoryXml()
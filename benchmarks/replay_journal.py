@@ -0,0 +1,127 @@
+"""Replay the journaled uploads and API edits of a state directory through a fresh proxy as fast as it accepts them.
+
+Every record is sent back through the handler that first received it, on a loopback port, with the records of
+each system in their original order and different systems replayed concurrently.  The records are read and
+decompressed before the replay starts, so only the proxy and its client are measured.  With --profile, the
+replay runs under cProfile, for a profile of production traffic without a thermostat.
+
+Run from the repository root:  python -m benchmarks.replay_journal ./state --profile replay.prof
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import cProfile
+import pstats
+import urllib.parse
+
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+
+from infinitytouch.infinityproxy import createApp, DIR_JOURNAL, FILE_SYSTEM, FILE_STATUS
+from infinitytouch.journal import readJournal, decodeEdits, RECORD_UPLOAD, RECORD_NOTIFICATION, RECORD_EDITS
+from infinitytouch.configindex import ConfigIndex
+from benchmarks.simulator import LatencyRecorder, FORM_HEADERS
+
+
+def buildRequest(systemID, record):
+    """Return the route name, path and body that reproduce a journal record, or None for an unknown record type."""
+    if record.kind == RECORD_UPLOAD:
+        if record.name == FILE_SYSTEM:
+            suffix = ""
+        elif record.name == FILE_STATUS:
+            suffix = "/status"
+        else:
+            suffix = "/" + os.path.splitext(record.name)[0]
+        return "POST /systems/<id>" + suffix, "/systems/{}{}".format(systemID, suffix), urllib.parse.urlencode({"data": record.body})
+    if record.kind == RECORD_NOTIFICATION:
+        return "POST /systems/<id>/notifications", "/systems/{}/notifications".format(systemID), urllib.parse.urlencode({"data": record.body})
+    if record.kind == RECORD_EDITS:
+        edits = [{"path": ConfigIndex.getConfigPath(anchorKey, drilldownPath), "value": value} for anchorKey, drilldownPath, value in decodeEdits(record.body)]
+        return "POST /api/<id>/config/batch", "/api/{}/config/batch".format(systemID), json.dumps(edits)
+    return None
+
+
+def loadRequests(stateDir, systemIDs=None):
+    """Map each system with a journal to the requests that replay it."""
+    requests = {}
+    for systemID in sorted(os.listdir(stateDir)):
+        journalDirectory = os.path.join(stateDir, systemID, DIR_JOURNAL)
+        if (systemIDs and systemID not in systemIDs) or not os.path.isdir(journalDirectory):
+            continue
+        requests[systemID] = [request for request in (buildRequest(systemID, record) for record in readJournal(journalDirectory)) if request is not None]
+    return requests
+
+
+async def replaySystem(baseUrl, requests, recorder):
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+    try:
+        for route, path, body in requests:
+            headers = FORM_HEADERS if route.startswith("POST /systems") else None
+            await recorder.fetch(client, route, baseUrl + path, method="POST", body=body, headers=headers)
+    finally:
+        client.close()
+
+
+async def replay(requests, repeat):
+    # The state writer may still be saving in the background when the directory is removed
+    with tempfile.TemporaryDirectory(prefix="infinity-replay-", ignore_cleanup_errors=True) as stateDir:
+        return await replayInto(stateDir, requests, repeat)
+
+
+async def replayInto(stateDir, requests, repeat):
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    # The replayed traffic is not journaled again
+    server = tornado.httpserver.HTTPServer(createApp(stateDir=stateDir, journalSize=0))
+    server.add_sockets(sockets)
+    baseUrl = "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+
+    recorder = LatencyRecorder()
+    start = time.monotonic()
+    for _ in range(repeat):
+        await asyncio.gather(*(replaySystem(baseUrl, systemRequests, recorder) for systemRequests in requests.values()))
+    duration = time.monotonic() - start
+    server.stop()
+    return recorder.summarize(duration), duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("stateDir", help="state directory of the proxy whose journals are replayed")
+    parser.add_argument("--system", action="append", dest="systems", help="only replay this system; may be repeated")
+    parser.add_argument("--repeat", type=int, default=1, help="times to replay the journals")
+    parser.add_argument("--profile", help="file to save cProfile statistics of the replay to")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the proxy")
+    args = parser.parse_args()
+
+    logging.getLogger("InfinityProxy").setLevel(args.log_level)
+    requests = loadRequests(args.stateDir, args.systems)
+    count = sum(len(systemRequests) for systemRequests in requests.values()) * args.repeat
+    if not count:
+        sys.exit("No journal records found in {}".format(args.stateDir))
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    routes, duration = asyncio.run(replay(requests, args.repeat))
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    print("Replayed {} requests for {} systems in {:.2f} s ({:.0f} req/s)".format(count, len(requests), duration, count / duration))
+    print("{:<40} {:>8} {:>9} {:>9} {:>7}".format("route", "requests", "p50 ms", "p99 ms", "errors"))
+    for route, stats in sorted(routes.items()):
+        print("{:<40} {:>8} {:>9.2f} {:>9.2f} {:>7}".format(route, stats["count"], stats["p50_ms"], stats["p99_ms"], stats["errors"]))
+    if profiler is not None:
+        print("Profile saved to {}".format(args.profile))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Simulated Infinity thermostats and API clients for load testing the proxy on a local port."""
+
+import time
+import json
+import random
+import urllib.parse
+
+import tornado.gen
+import tornado.httpclient
+
+from benchmarks.fixtures import SYSTEM_XML, NOTIFICATION_XML, buildStatusXml, buildHistoryXml
+
+API_PATHS = ["/api/{}/status.json", "/api/{}/system.xml", "/api/{}/config/zones/1", "/api/{}/config/zones/1/activities/home/htsp",
+             "/api/{}/config/zones/2/program/Monday/3"]
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+class LatencyRecorder:
+    """Latencies and error counts per route, for percentiles once the run is over."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    async def fetch(self, client, route, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.fetch(url, raise_error=False, **kwargs)
+        except Exception:
+            response = None
+        elapsed = time.perf_counter() - start
+        self.latencies.setdefault(route, []).append(elapsed)
+        if response is None or response.code >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+    def summarize(self, duration):
+        summary = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            summary[route] = {
+                "count": len(latencies),
+                "errors": self.errors.get(route, 0),
+                "throughput": len(latencies) / duration,
+                "p50_ms": percentile(latencies, 0.50) * 1e3,
+                "p99_ms": percentile(latencies, 0.99) * 1e3,
+                "max_ms": latencies[-1] * 1e3
+            }
+        return summary
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+
+def encodeForm(data):
+    return urllib.parse.urlencode({"data": data})
+
+
+class ThermostatSimulator:
+    """Replay the requests of one thermostat: a status ping at a fixed rate, pulling the config whenever the
+    proxy reports changes and acknowledging it with a notification, and periodic config and history uploads.
+    """
+
+    def __init__(self, baseUrl, systemID, recorder, statusInterval=1.0, uploadInterval=30.0, historyEntries=500):
+        self.baseUrl = baseUrl
+        self.systemID = systemID
+        self.recorder = recorder
+        self.statusInterval = statusInterval
+        self.uploadInterval = uploadInterval
+        self.historyXml = buildHistoryXml(historyEntries)
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        self.step = 0
+
+    def getUrl(self, path=""):
+        return "{}/systems/{}{}".format(self.baseUrl, self.systemID, path)
+
+    async def post(self, route, path, data):
+        return await self.recorder.fetch(self.client, route, self.getUrl(path), method="POST", body=encodeForm(data), headers=FORM_HEADERS)
+
+    async def uploadConfig(self):
+        await self.post("POST /systems/<id>", "", SYSTEM_XML)
+
+    async def seed(self):
+        """Send an initial config and status, so the API has something to serve before the measurement starts."""
+        for path, data in (("", SYSTEM_XML), ("/status", buildStatusXml())):
+            await self.client.fetch(self.getUrl(path), method="POST", body=encodeForm(data), headers=FORM_HEADERS)
+
+    async def run(self, deadline):
+        nextUpload = time.monotonic() + self.uploadInterval
+        # Spread the pings of different thermostats across the interval
+        nextPing = time.monotonic() + random.random() * self.statusInterval
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if nextPing > now:
+                await tornado.gen.sleep(min(nextPing, deadline) - now)
+                continue
+            nextPing += self.statusInterval
+            self.step += 1
+            response = await self.post("POST /systems/<id>/status", "/status", buildStatusXml(step=self.step))
+            if response is not None and b"<configHasChanges>true" in (response.body or b""):
+                await self.recorder.fetch(self.client, "GET /systems/<id>/config", self.getUrl("/config"))
+                await self.post("POST /systems/<id>/notifications", "/notifications", NOTIFICATION_XML)
+            if time.monotonic() >= nextUpload:
+                nextUpload += self.uploadInterval
+                await self.post("POST /systems/<id>/history", "/history", self.historyXml)
+                await self.uploadConfig()
+        self.client.close()
+
+
+class ApiClient:
+    """Poll the API like a home automation integration, revalidating with ETags, and occasionally change a setpoint."""
+
+    def __init__(self, baseUrl, systemIDs, recorder, editRate=0.02, useETags=True):
+        self.baseUrl = baseUrl
+        self.systemIDs = systemIDs
+        self.recorder = recorder
+        self.editRate = editRate
+        self.useETags = useETags
+        self.entityTags = {}
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    async def run(self, deadline):
+        count = 0
+        while time.monotonic() < deadline:
+            systemID = self.systemIDs[count % len(self.systemIDs)]
+            count += 1
+            if random.random() < self.editRate:
+                body = json.dumps({"htsp": "{:.1f}".format(random.uniform(60, 70))})
+                await self.recorder.fetch(self.client, "POST /api/<id>/config/zones/1/activities/home", "{}/api/{}/config/zones/1/activities/home".format(self.baseUrl, systemID),
+                                          method="POST", body=body)
+                continue
+            path = API_PATHS[count % len(API_PATHS)]
+            url = self.baseUrl + path.format(systemID)
+            headers = {"Accept-Encoding": "gzip"}
+            if self.useETags and url in self.entityTags:
+                headers["If-None-Match"] = self.entityTags[url]
+            response = await self.recorder.fetch(self.client, "GET " + path.format("<id>"), url, headers=headers, decompress_response=False)
+            if response is not None and "Etag" in response.headers:
+                self.entityTags[url] = response.headers["Etag"]
+        self.client.close()
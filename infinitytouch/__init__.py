@@ -1 +1,9 @@
-from .api import *
\ No newline at end of file
+# The models are imported on first use, so that importing the package does not load the state store and Tornado
+__all__ = ["System", "Zone", "Activity", "ProgramDay", "Period", "Status", "ZoneStatus", "EquipmentStatus", "Notification", "Change"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
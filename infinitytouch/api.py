@@ -0,0 +1,3 @@
+from .model import System, Zone, Activity, ProgramDay, Period, Status, ZoneStatus, EquipmentStatus, Notification, Change
+
+__all__ = ["System", "Zone", "Activity", "ProgramDay", "Period", "Status", "ZoneStatus", "EquipmentStatus", "Notification", "Change"]
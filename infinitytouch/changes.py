@@ -0,0 +1,117 @@
+import json
+import time
+import asyncio
+import logging
+from .metrics import metrics
+
+logger = logging.getLogger("InfinityProxy")
+
+# Categories of server-side changes, and the status response element that tells the thermostat to pull each one
+CATEGORY_ELEMENTS = {
+    "config": "configHasChanges",
+    "dealer": "dealerHasChanges",
+    "dealerLogo": "dealerLogoHasChanges",
+    "idu": "iduConfigHasChanges",
+    "odu": "oduConfigHasChanges",
+    "utilityEvents": "utilityEventsHasChanges"
+}
+PULL_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class ChangeTracker:
+    """Track the categories of changes that are waiting for the thermostat to pull them, and when each was queued.
+
+    The state is kept in memory and written to disk in the background for crash recovery.  The status
+    response flags are recomputed only when the state changes, so each ping just reads a prepared dict.
+    """
+
+    def __init__(self, filePath, writer):
+        self.filePath = filePath
+        self.writer = writer
+        self.queued = {}
+        self.roundTrips = {}
+        self.elementTextUpdates = {}
+        self.loading = None
+
+    async def load(self):
+        """Restore the changes that were pending when the proxy last stopped.  Only reads the file once."""
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self.readState())
+        await self.loading
+
+    async def readState(self):
+        try:
+            data, mtime = await self.writer.read(self.filePath)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error("Failed to read '%s': %s'", self.filePath, e)
+            return
+        try:
+            queued = json.loads(data)
+        except ValueError:
+            queued = None
+        if not isinstance(queued, dict):
+            # Written by an older version as a bare flag for config changes
+            queued = {"config": mtime}
+        for category, queuedTime in queued.items():
+            if category not in CATEGORY_ELEMENTS:
+                continue
+            try:
+                queuedTime = float(queuedTime)
+            except (ValueError, TypeError):
+                logger.warning("Ignoring %s changes with invalid queue time %r in '%s'", category, queuedTime, self.filePath)
+                continue
+            self.queued.setdefault(category, queuedTime)
+        self.update()
+
+    def isChanged(self, category=None):
+        return bool(self.queued) if category is None else category in self.queued
+
+    async def markChanged(self, category="config"):
+        """Queue a category of changes for the thermostat, returning once the change has been saved."""
+        if category not in CATEGORY_ELEMENTS:
+            raise KeyError(category)
+        if category in self.queued:
+            return
+        self.queued[category] = time.time()
+        self.update()
+        await self.persist()
+
+    def markPulled(self, category="config"):
+        """Clear a category once the thermostat has pulled it, returning the seconds since it was queued.
+
+        The cleared state is saved in the background, since losing it only means the thermostat pulls again.
+        """
+        queuedTime = self.queued.pop(category, None)
+        if queuedTime is None:
+            return None
+        roundTrip = max(time.time() - queuedTime, 0.0)
+        self.roundTrips[category] = roundTrip
+        metrics.observe("infinity_change_pull_seconds", roundTrip, (("category", category),), PULL_BUCKETS)
+        logger.info("Thermostat pulled %s changes %.1f seconds after they were queued", category, roundTrip)
+        self.update()
+        self.persist().add_done_callback(self.logPersistFailure)
+        return roundTrip
+
+    def update(self):
+        elementTextUpdates = {CATEGORY_ELEMENTS[category]: "true" for category in self.queued}
+        if elementTextUpdates:
+            elementTextUpdates["serverHasChanges"] = "true"
+        self.elementTextUpdates = elementTextUpdates
+
+    def persist(self):
+        return self.writer.write(self.filePath, json.dumps(self.queued).encode() if self.queued else None)
+
+    def logPersistFailure(self, future):
+        # Retrieves the exception of a save nobody awaits, so it is logged here rather than reported as never retrieved
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Failed to save pending changes to '%s': %s", self.filePath, future.exception())
+
+    def getSummary(self):
+        now = time.time()
+        return {
+            "pending": {category: {"queued": queuedTime, "age": round(now - queuedTime, 3)} for category, queuedTime in self.queued.items()},
+            "lastRoundTrip": {category: round(roundTrip, 3) for category, roundTrip in self.roundTrips.items()}
+        }
+
@@ -0,0 +1,83 @@
+import logging
+
+logger = logging.getLogger("InfinityProxy")
+
+MAX_CACHED_DRILLDOWNS = 4096
+
+
+class ConfigIndex:
+    """Map the zone, activity and program routes of the API straight to their elements in a parsed system.xml.
+
+    The index only depends on the structure of the tree, so it stays valid while element text is edited
+    and only needs rebuilding when the thermostat sends a new system config.
+    """
+
+    def __init__(self, root):
+        self.config = root.find("./config")
+        self.anchors = {}
+        self.drilldowns = {}
+        if self.config is None:
+            return
+        self.anchors[("Config",)] = self.config
+        for activity in self.config.iterfind("./wholeHouse/activities/activity"):
+            self.anchors.setdefault(("WholeHouseActivity", activity.get("id")), activity)
+        for zone in self.config.iterfind("./zones/zone"):
+            zoneID = zone.get("id")
+            self.anchors.setdefault(("Zone", zoneID), zone)
+            for activity in zone.iterfind("./activities/activity"):
+                self.anchors.setdefault(("ZoneActivity", zoneID, activity.get("id")), activity)
+            for day in zone.iterfind("./program/day"):
+                dayID = day.get("id")
+                self.anchors.setdefault(("ZoneProgram", zoneID, dayID), day)
+                for period in day.iterfind("./period"):
+                    self.anchors.setdefault(("ZoneProgramPeriod", zoneID, dayID, period.get("id")), period)
+        logger.debug("Indexed %d config elements", len(self.anchors))
+
+    @staticmethod
+    def getAnchorKey(xpathName, pathVars):
+        if xpathName == "Config":
+            return ("Config",)
+        if xpathName == "WholeHouseActivity":
+            return (xpathName, pathVars["activityID"])
+        if xpathName == "Zone":
+            return (xpathName, pathVars["zoneID"])
+        if xpathName == "ZoneActivity":
+            return (xpathName, pathVars["zoneID"], pathVars["activityID"])
+        if xpathName == "ZoneProgram":
+            return (xpathName, pathVars["zoneID"], pathVars["dayID"])
+        if xpathName == "ZoneProgramPeriod":
+            return (xpathName, pathVars["zoneID"], pathVars["dayID"], pathVars["periodID"])
+        raise KeyError(xpathName)
+
+    @staticmethod
+    def getConfigPath(anchorKey, drilldownPath=""):
+        """Return the config API path of an anchor and drilldown path, the inverse of routing a path to getAnchorKey()."""
+        xpathName = anchorKey[0]
+        if xpathName == "Config":
+            path = "/config"
+        elif xpathName == "WholeHouseActivity":
+            path = "/config/wholeHouse/activities/activity/{}".format(*anchorKey[1:])
+        elif xpathName == "Zone":
+            path = "/config/zones/{}".format(*anchorKey[1:])
+        elif xpathName == "ZoneActivity":
+            path = "/config/zones/{}/activities/{}".format(*anchorKey[1:])
+        elif xpathName == "ZoneProgram":
+            path = "/config/zones/{}/program/{}".format(*anchorKey[1:])
+        elif xpathName == "ZoneProgramPeriod":
+            path = "/config/zones/{}/program/{}/{}".format(*anchorKey[1:])
+        else:
+            raise KeyError(xpathName)
+        return path + drilldownPath
+
+    def find(self, anchorKey, drilldownPath=""):
+        """Return the element at a drilldown path below an indexed element, or None if there is none."""
+        anchor = self.anchors.get(anchorKey)
+        if anchor is None or not drilldownPath:
+            return anchor
+        cacheKey = (anchorKey, drilldownPath)
+        element = self.drilldowns.get(cacheKey)
+        if element is None:
+            element = anchor.find("." + drilldownPath)
+            if element is not None and len(self.drilldowns) < MAX_CACHED_DRILLDOWNS:
+                self.drilldowns[cacheKey] = element
+        return element
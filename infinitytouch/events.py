@@ -0,0 +1,134 @@
+import logging
+import collections
+import tornado.locks
+
+logger = logging.getLogger("InfinityProxy")
+
+DEFAULT_QUEUE_SIZE = 64
+
+
+def flattenElement(element, path="", snapshot=None):
+    """Map the path of every leaf element below an element to its text.
+
+    Elements with an id attribute are addressed by it, and other repeated elements by their position.
+    """
+    if snapshot is None:
+        snapshot = {}
+    counts = {}
+    for child in element:
+        childID = child.get("id")
+        if childID is not None:
+            childPath = "{}/{}[@id='{}']".format(path, child.tag, childID)
+        else:
+            counts[child.tag] = counts.get(child.tag, 0) + 1
+            childPath = "{}/{}".format(path, child.tag)
+            if counts[child.tag] > 1:
+                childPath = "{}[{}]".format(childPath, counts[child.tag])
+        if len(child):
+            flattenElement(child, childPath, snapshot)
+        else:
+            snapshot[childPath.lstrip("/")] = child.text or ""
+    return snapshot
+
+
+def diffSnapshots(oldSnapshot, newSnapshot):
+    """Return the leaves whose text changed or that were added, and the paths that were removed."""
+    changed = {path: text for path, text in newSnapshot.items() if oldSnapshot.get(path) != text}
+    removed = [path for path in oldSnapshot if path not in newSnapshot]
+    return changed, removed
+
+
+class Subscription:
+    """Bounded queue of change events for one streaming client.  The oldest events are dropped when it is full.
+
+    The sources the client has been sent a snapshot of are tracked in seeded.  Once an event is dropped the client
+    can no longer apply later changes reliably, so the next event of every source is a full snapshot again.
+    """
+
+    def __init__(self, systemID=None, maxSize=DEFAULT_QUEUE_SIZE):
+        self.systemID = systemID
+        self.queue = collections.deque(maxlen=maxSize)
+        self.dropped = 0
+        self.closed = False
+        self.ready = tornado.locks.Event()
+        self.seeded = set()
+
+    def put(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            self.seeded.clear()
+        self.queue.append(event)
+        self.ready.set()
+
+    async def get(self):
+        """Wait for the next event, returning None once the subscription is closed."""
+        while not self.queue and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        if self.closed:
+            return None
+        event = self.queue.popleft()
+        if self.dropped:
+            event = dict(event, dropped=self.dropped)
+            self.dropped = 0
+        return event
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+class ChangeBroker:
+    """Fan out the changes in thermostat status and config to streaming API clients.
+
+    Each client is first sent a "snapshot" event with every leaf of a status or config tree, and then "changes"
+    events with the leaves that differ from the previous tree.  Snapshots are only kept while someone is subscribed,
+    so publishing is nearly free otherwise.
+    """
+
+    def __init__(self, queueSize=DEFAULT_QUEUE_SIZE):
+        self.queueSize = queueSize
+        self.subscriptions = set()
+        self.snapshots = {}
+
+    def subscribe(self, systemID=None):
+        subscription = Subscription(systemID, self.queueSize)
+        self.subscriptions.add(subscription)
+        logger.debug("Change stream subscribed for system '%s' (%d subscribers)", systemID, len(self.subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        self.subscriptions.discard(subscription)
+        if not self.subscriptions:
+            self.snapshots.clear()
+
+    def hasSubscribers(self, systemID):
+        return any(subscription.systemID in (None, systemID) for subscription in self.subscriptions)
+
+    def publishElement(self, systemID, source, root):
+        """Publish a status or config tree, as a snapshot to new subscribers and as its changed leaves to the rest."""
+        if not self.hasSubscribers(systemID):
+            return
+        key = (systemID, source)
+        snapshot = flattenElement(root)
+        changes = None
+        if key in self.snapshots:
+            changed, removed = diffSnapshots(self.snapshots[key], snapshot)
+            if changed or removed:
+                changes = {"source": source, "type": "changes", "changed": changed, "removed": removed, "systemID": systemID}
+        self.snapshots[key] = snapshot
+        for subscription in self.getSubscriptions(systemID):
+            if key not in subscription.seeded:
+                subscription.put({"source": source, "type": "snapshot", "values": snapshot, "systemID": systemID})
+                subscription.seeded.add(key)
+            elif changes is not None:
+                subscription.put(changes)
+
+    def publish(self, systemID, event):
+        event = dict(event, systemID=systemID)
+        for subscription in self.getSubscriptions(systemID):
+            subscription.put(event)
+
+    def getSubscriptions(self, systemID):
+        return [subscription for subscription in self.subscriptions if subscription.systemID in (None, systemID)]
@@ -0,0 +1,214 @@
+import os
+import json
+import math
+import time
+import struct
+import fnmatch
+import logging
+import calendar
+from .state import writeFileAtomic
+
+logger = logging.getLogger("InfinityProxy")
+
+# Raw samples: timestamp, field ID, value
+RAW_RECORD = struct.Struct("<dHf")
+# Downsampled samples: bucket start, field ID, min, max, sum, count
+AGGREGATE_RECORD = struct.Struct("<dHffdI")
+
+AGGREGATE_INTERVAL = 300
+RAW_RETENTION_DAYS = 7
+MAX_QUERY_POINTS = 1000
+MAX_FIELDS = 65535
+READ_CHUNK_RECORDS = 4096
+# Queries are limited to times that map to a UTC day, from the epoch to the end of year 9999
+MIN_TIMESTAMP = 0
+MAX_TIMESTAMP = 253402300799
+FILE_CATALOG = "fields.json"
+
+# Equipment operating states, mapped to a stage number so they can be trended
+STAGE_VALUES = {
+    "off": 0, "idle": 0, "on": 1, "low": 1, "med": 2, "medium": 2, "high": 3,
+    "stage1": 1, "stage2": 2, "stage3": 3, "stage4": 4, "stage5": 5
+}
+
+
+def extractSamples(element, prefix="", samples=None):
+    """Map the dotted name of every numeric leaf in a status tree to its value.
+
+    Elements with an id attribute are named by tag and id, such as zones.zone1.rt.
+    """
+    if samples is None:
+        samples = {}
+    for child in element:
+        name = prefix + child.tag + (child.get("id") or "")
+        if len(child):
+            extractSamples(child, name + ".", samples)
+            continue
+        text = (child.text or "").strip()
+        if not text:
+            continue
+        try:
+            value = float(text)
+        except ValueError:
+            if child.tag != "opstat":
+                continue
+            value = STAGE_VALUES.get(text.lower())
+            if value is None:
+                continue
+        if math.isfinite(value):
+            samples[name] = value
+    return samples
+
+
+def getDayKey(timestamp):
+    return time.strftime("%Y%m%d", time.gmtime(timestamp))
+
+
+def getDayStart(dayKey):
+    return calendar.timegm(time.strptime(dayKey, "%Y%m%d"))
+
+
+def iterRecords(filePath, recordFormat):
+    """Yield the complete records of a segment file, reading it in fixed-size chunks."""
+    try:
+        f = open(filePath, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            chunk = f.read(recordFormat.size * READ_CHUNK_RECORDS)
+            usable = len(chunk) - len(chunk) % recordFormat.size
+            if usable:
+                yield from recordFormat.iter_unpack(chunk[:usable])
+            if len(chunk) < recordFormat.size * READ_CHUNK_RECORDS:
+                return
+
+
+class HistoryStore:
+    """Append-only time series of the numeric status readings for one system.
+
+    Samples are appended to a raw segment file per UTC day.  Raw segments older than RAW_RETENTION_DAYS
+    are compacted into segments of AGGREGATE_INTERVAL min/max/sum/count buckets.  Queries stream the
+    segments that overlap their range, so memory use depends on the number of points returned, not samples stored.
+    """
+
+    def __init__(self, directory, writer):
+        self.directory = directory
+        self.writer = writer
+        self.catalog = None
+        self.lastDay = None
+
+    def getSegmentPath(self, kind, dayKey):
+        return os.path.join(self.directory, "{}-{}.seg".format(kind, dayKey))
+
+    def getSegmentDays(self):
+        """Return the sorted day keys of the raw and downsampled segments that exist."""
+        try:
+            fileNames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted({fileName[4:-4] for fileName in fileNames if fileName.startswith(("raw-", "agg-")) and fileName.endswith(".seg")})
+
+    def readCatalog(self):
+        try:
+            with open(os.path.join(self.directory, FILE_CATALOG), 'rb') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    async def record(self, root, timestamp=None):
+        """Append the numeric readings of a status tree."""
+        samples = extractSamples(root)
+        if samples:
+            await self.writer.run(self.appendSamples, timestamp or time.time(), samples)
+
+    def appendSamples(self, timestamp, samples):
+        if self.catalog is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.catalog = self.readCatalog()
+        newFields = [name for name in samples if name not in self.catalog]
+        for name in newFields:
+            if len(self.catalog) < MAX_FIELDS:
+                self.catalog[name] = len(self.catalog)
+        if newFields:
+            writeFileAtomic(os.path.join(self.directory, FILE_CATALOG), json.dumps(self.catalog).encode())
+
+        data = b"".join(RAW_RECORD.pack(timestamp, self.catalog[name], value) for name, value in samples.items() if name in self.catalog)
+        dayKey = getDayKey(timestamp)
+        with open(self.getSegmentPath("raw", dayKey), 'ab') as f:
+            f.write(data)
+        if dayKey != self.lastDay:
+            self.lastDay = dayKey
+            self.compact(timestamp)
+
+    def compact(self, now):
+        """Downsample the raw segments that are older than the raw retention period."""
+        cutoff = getDayKey(now - RAW_RETENTION_DAYS * 86400)
+        for fileName in sorted(os.listdir(self.directory)):
+            if not (fileName.startswith("raw-") and fileName.endswith(".seg")):
+                continue
+            dayKey = fileName[4:-4]
+            if dayKey >= cutoff:
+                continue
+            buckets = {}
+            for timestamp, fieldID, value in iterRecords(self.getSegmentPath("raw", dayKey), RAW_RECORD):
+                key = (timestamp - timestamp % AGGREGATE_INTERVAL, fieldID)
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = [value, value, value, 1]
+                else:
+                    bucket[0] = min(bucket[0], value)
+                    bucket[1] = max(bucket[1], value)
+                    bucket[2] += value
+                    bucket[3] += 1
+            data = b"".join(AGGREGATE_RECORD.pack(start, fieldID, *bucket) for (start, fieldID), bucket in sorted(buckets.items()))
+            writeFileAtomic(self.getSegmentPath("agg", dayKey), data)
+            os.remove(self.getSegmentPath("raw", dayKey))
+            logger.info("Compacted history for %s into %d buckets", dayKey, len(buckets))
+
+    def query(self, start, end, fieldPatterns=None, step=None):
+        """Aggregate the samples between two timestamps into buckets of step seconds.
+
+        Field patterns may use shell-style wildcards, such as zones.zone*.rt.  Returns a dict with a
+        [time, avg, min, max, count] row for every bucket of every field that has samples, with
+        bucket times aligned to multiples of step.
+        """
+        catalog = self.readCatalog()
+        if fieldPatterns:
+            fieldNames = {fieldID: name for name, fieldID in catalog.items() if any(fnmatch.fnmatchcase(name, pattern) for pattern in fieldPatterns)}
+        else:
+            fieldNames = {fieldID: name for name, fieldID in catalog.items()}
+        span = max(end - start, 1)
+        step = max(int(step or 0), math.ceil(span / MAX_QUERY_POINTS), 1)
+
+        buckets = {}
+
+        def addToBucket(timestamp, fieldID, low, high, total, count):
+            if fieldID not in fieldNames or not start <= timestamp < end:
+                return
+            key = (fieldID, int(timestamp // step))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [low, high, total, count]
+            else:
+                bucket[0] = min(bucket[0], low)
+                bucket[1] = max(bucket[1], high)
+                bucket[2] += total
+                bucket[3] += count
+
+        firstDay = getDayKey(start)
+        for dayKey in self.getSegmentDays():
+            if dayKey < firstDay or getDayStart(dayKey) >= end:
+                continue
+            rawPath = self.getSegmentPath("raw", dayKey)
+            if os.path.exists(rawPath):
+                for timestamp, fieldID, value in iterRecords(rawPath, RAW_RECORD):
+                    addToBucket(timestamp, fieldID, value, value, value, 1)
+            else:
+                for record in iterRecords(self.getSegmentPath("agg", dayKey), AGGREGATE_RECORD):
+                    addToBucket(*record)
+
+        fields = {}
+        for (fieldID, index), (low, high, total, count) in sorted(buckets.items()):
+            fields.setdefault(fieldNames[fieldID], []).append([index * step, round(total / count, 3), round(low, 3), round(high, 3), count])
+        return {"from": start, "to": end, "step": step, "columns": ["time", "avg", "min", "max", "count"], "fields": fields}
@@ -1,53 +1,293 @@
 import os
+import sys
+import signal
 import logging
 import xml.etree.ElementTree as ET
-import re
 import datetime
-import urllib.request
+import time
+import asyncio
 import tornado.ioloop
 import tornado.web
-import xmltodict
+import tornado.netutil
+import tornado.httpserver
+import tornado.iostream
+import tornado.httputil
 import json
+import gzip
+import email.utils
+import functools
+import re
+from xml.sax.saxutils import escape
+from .state import StateRegistry, formatOutgoingXml, elementToDict
+from .configindex import ConfigIndex
+from .events import ChangeBroker
+from .metrics import metrics, SIZE_BUCKETS
+from .history import HistoryStore, MIN_TIMESTAMP, MAX_TIMESTAMP
+from .upload import FormFieldDecoder
+from .model import System, Notification, Change
+from .changes import ChangeTracker
+from .journal import Journal, recoverState, encodeEdits, DEFAULT_JOURNAL_SIZE, RECORD_UPLOAD, RECORD_NOTIFICATION, RECORD_EDITS
 
 LOG_FORMAT = "%(asctime)s,%(msecs)03d %(name)s[%(process)d] %(levelname)s %(message)s"
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger("InfinityProxy")
 
-# Disable Tornado's access logging - we'll output ourselves
-hn = logging.NullHandler()
-hn.setLevel(logging.DEBUG)
-logging.getLogger("tornado.access").addHandler(hn)
-logging.getLogger("tornado.access").propagate = False
-
 DEFAULT_STATEDIR = "./state"
 DEFAULT_PORT = 3000
 DEFAULT_LOGLEVEL = "INFO"
+DEFAULT_MAXCACHEDSYSTEMS = 16
+DEFAULT_WEATHERBASEURL = "http://api.wunderground.com/api"
+DEFAULT_APIPORT = 3001
+DEFAULT_MAXUPLOADSIZE = 16 * 1024 * 1024
+GZIP_MIN_LENGTH = 1024
+GZIP_LEVEL = 6
+TIMESTAMP_SLOT = "[[slot:timestamp]]"
 
 FILE_SYSTEM = "system.xml"
 FILE_STATUS = "status.xml"
 FILE_CHANGEFLAG = "changes"
+DIR_HISTORY = "timeseries"
+DIR_JOURNAL = "journal"
 TYPE_XML = "text/xml"
 TYPE_JSON = "application/json"
 TYPE_TEXT = "text/plain"
+TYPE_METRICS = "text/plain; version=0.0.4"
+
+# Routes into system.xml, relative to the API prefix, with the name of the element they are anchored on
+CONFIG_ROUTES = [
+    # Special config handlers for lists contained in system.xml
+    (r"/config/wholeHouse/activities/activity/(?P<activityID>home|away|sleep|wake|manual)(?P<drilldownPath>.*)", "WholeHouseActivity"),
+    (r"/config/zones/(?P<optionalZone>zone/)?(?P<zoneID>[1-8])/activities/(?P<optionalActivity>activity/)?(?P<activityID>home|away|sleep|wake|manual)(?P<drilldownPath>.*)", "ZoneActivity"),
+    (r"/config/zones/(?P<OPTIONAL1>zone/)?(?P<zoneID>[1-8])/program/(?P<OPTIONAL2>day/)?(?P<dayID>Sunday|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday)/(?P<OPTIONAL3>period/)?(?P<periodID>[1-5])(?P<drilldownPath>.*)", "ZoneProgramPeriod"),
+    (r"/config/zones/(?P<OPTIONAL1>zone/)?(?P<zoneID>[1-8])/program/(?P<OPTIONAL2>day/)?(?P<dayID>Sunday|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday)(?P<drilldownPath>.*)", "ZoneProgram"),
+    (r"/config/zones/(?P<OPTIONAL1>zone/)?(?P<zoneID>[1-8])(?P<drilldownPath>.*)", "Zone"),
+    # Default config handler for system.xml
+    (r"/config(?P<drilldownPath>.*)", "Config")
+]
+
+def configureLogging(logLevel=DEFAULT_LOGLEVEL):
+    """Set up logging for the proxy when it runs as a service, rather than embedded in another application."""
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    logger.setLevel(logLevel)
+
+    # Disable Tornado's access logging - we'll output ourselves
+    hn = logging.NullHandler()
+    hn.setLevel(logging.DEBUG)
+    logging.getLogger("tornado.access").addHandler(hn)
+    logging.getLogger("tornado.access").propagate = False
+
+
+def getProcessUptime():
+    """Return the seconds since this process started, where /proc is available."""
+    try:
+        with open("/proc/self/stat") as f:
+            startTicks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(uptime - startTicks / os.sysconf("SC_CLK_TCK"), 0.0)
+
+
+async def warmState(stateRegistry):
+    """Parse and index the state of the known systems, so the first requests after a restart are served from memory."""
+    for systemID in list(stateRegistry.stores)[:stateRegistry.maxCachedSystems]:
+        store = stateRegistry.getStore(systemID)
+        await store.getDerived(FILE_SYSTEM, "configIndex", ConfigIndex)
+        await store.getRoot(FILE_STATUS)
+        if not stateRegistry.readOnly:
+            await loadChangeTracker(store)
+            getStatusResponseTemplate(systemID)
+
+
+def recoverJournals(stateDirectory):
+    """Rebuild the corrupted or stale state files of every system from its journal, returning the number rebuilt."""
+    try:
+        systemDirectories = [entry.path for entry in os.scandir(stateDirectory) if entry.is_dir() and not entry.name.startswith(".")]
+    except FileNotFoundError:
+        return 0
+    recovered = 0
+    for systemDirectory in sorted(systemDirectories):
+        recovered += len(recoverState(systemDirectory, os.path.join(systemDirectory, DIR_JOURNAL)))
+    return recovered
+
+
+def forkProcesses(count, maxRestarts=100):
+    """Fork count child processes, returning the task ID from 0 to count - 1 in each child.
+
+    Like tornado.process.fork_processes(), the parent never returns: it restarts children that die abnormally
+    and exits once all of them have exited.  It also forwards SIGTERM and SIGINT to the children and then
+    waits for them, so stopping the service's main process stops all of its processes.
+    """
+    children = {}
+    stopping = []
+
+    def startChild(taskID):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            return taskID
+        children[pid] = taskID
+        return None
+
+    def stopChildren(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stopChildren)
+    signal.signal(signal.SIGINT, stopChildren)
+    for taskID in range(count):
+        if startChild(taskID) is not None:
+            return taskID
+    restarts = 0
+    while children:
+        pid, status = os.wait()
+        taskID = children.pop(pid, None)
+        if taskID is None or stopping or os.waitstatus_to_exitcode(status) == 0:
+            continue
+        logger.warning("Child %d (pid %d) exited with status %d, restarting", taskID, pid, os.waitstatus_to_exitcode(status))
+        restarts += 1
+        if restarts > maxRestarts:
+            raise RuntimeError("Too many child restarts, giving up")
+        if startChild(taskID) is not None:
+            return taskID
+    sys.exit(0)
+
+
+def acceptsGzip(acceptEncoding):
+    """Whether an Accept-Encoding header allows a gzipped response, honouring q-values and the * wildcard."""
+    qualities = {}
+    for item in acceptEncoding.split(","):
+        coding, *parameters = item.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    # An explicit gzip entry overrides the wildcard
+    quality = qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0)))
+    return quality > 0
+
+
+async def loadChangeTracker(store):
+    """Return the change tracker of a store, creating it and loading its saved state on first use."""
+    if store.changes is None:
+        store.changes = ChangeTracker(store.getPath(FILE_CHANGEFLAG), store.writer)
+    changes = store.changes
+    await changes.load()
+    return changes
+
+
+def createApp(**options):
+    """Build the proxy's Tornado application without starting a server, for embedding or testing."""
+    return InfinityProxy(start=False, **options).createApp()
 
-class InfinityProxy:
 
-    def __init__(self, wundergroundApiKey="", port=DEFAULT_PORT, logLevel=DEFAULT_LOGLEVEL, stateDir=DEFAULT_STATEDIR):
-        logger.setLevel(logLevel)
-        os.makedirs(stateDir, exist_ok=True)
+class InfinityProxy:
 
-        logger.info("Starting the Infinity proxy service on port %s", port)
+    def __init__(self, wundergroundApiKey="", port=DEFAULT_PORT, logLevel=DEFAULT_LOGLEVEL, stateDir=DEFAULT_STATEDIR,
+                 defaultSystemID=None, maxCachedSystems=DEFAULT_MAXCACHEDSYSTEMS, weatherBaseUrl=DEFAULT_WEATHERBASEURL,
+                 apiWorkers=0, apiPort=DEFAULT_APIPORT, maxUploadSize=DEFAULT_MAXUPLOADSIZE, journalSize=DEFAULT_JOURNAL_SIZE,
+                 compressJournal=True, start=True):
+        self.wundergroundApiKey = str(wundergroundApiKey)
+        self.port = int(port)
+        self.logLevel = logLevel
+        self.stateDir = stateDir
+        self.defaultSystemID = defaultSystemID
+        self.maxCachedSystems = maxCachedSystems
+        self.weatherBaseUrl = weatherBaseUrl
+        self.apiWorkers = int(apiWorkers)
+        self.apiPort = int(apiPort)
+        self.maxUploadSize = int(maxUploadSize)
+        self.journalSize = int(journalSize)
+        self.compressJournal = bool(compressJournal)
+        if start:
+            self.run()
+
+    def createApp(self, readOnly=False, sharedFiles=(), epoch=None):
+        """Build the application, or the read-only API of a pre-fork worker, registering the systems already in the state directory."""
+        os.makedirs(self.stateDir, exist_ok=True)
+        stateRegistry = StateRegistry(self.stateDir, self.defaultSystemID, self.maxCachedSystems, sharedFiles=sharedFiles, readOnly=readOnly, epoch=epoch,
+                                      legacyFiles=(FILE_SYSTEM, FILE_STATUS, FILE_CHANGEFLAG))
+        stateRegistry.discover()
         appSettings = {
-            "wundergroundApiKey" : str(wundergroundApiKey),
-            "stateDirectory" : stateDir
+            "wundergroundApiKey" : self.wundergroundApiKey,
+            "weatherBaseUrl" : self.weatherBaseUrl,
+            "forecastCache" : ForecastCache(),
+            "stateDirectory" : self.stateDir,
+            "stateRegistry" : stateRegistry,
+            "changeBroker" : ChangeBroker(),
+            "readOnly" : readOnly,
+            "maxUploadSize" : self.maxUploadSize,
+            "journalSize" : self.journalSize,
+            "compressJournal" : self.compressJournal
         }
-        app = self.getTornadoApp(appSettings)
-        app.listen(int(port))
+        if readOnly:
+            return self.getApiWorkerApp(appSettings)
+        return self.getTornadoApp(appSettings)
+
+    def run(self):
+        """Serve the proxy until interrupted."""
+        configureLogging(self.logLevel)
+        if self.journalSize > 0:
+            # Before any process loads the state, so a corrupted file is never cached
+            recoverStarted = time.perf_counter()
+            recovered = recoverJournals(self.stateDir)
+            metrics.observe("infinity_startup_seconds", time.perf_counter() - recoverStarted, (("phase", "recover"),))
+            if recovered:
+                logger.warning("Recovered %d state files from the journals", recovered)
+
+        # In pre-fork mode, task 0 owns the thermostat protocol and all writes, and the other tasks
+        # serve read-only API requests on a shared socket, following the writer's published generations
+        taskID = None
+        apiSockets = []
+        # Chosen before forking so that every process hands out the same entity tags
+        epoch = os.urandom(4).hex()
+        if self.apiWorkers > 0:
+            apiSockets = tornado.netutil.bind_sockets(self.apiPort)
+            taskID = forkProcesses(self.apiWorkers + 1)
+        sharedFiles = (FILE_SYSTEM, FILE_STATUS) if self.apiWorkers > 0 else ()
+        isApiWorker = bool(taskID)
+
+        app = self.createApp(readOnly=isApiWorker, sharedFiles=sharedFiles, epoch=epoch)
+        # Load the state before accepting connections, so the thermostat's first ping is answered from memory
+        warmStarted = time.perf_counter()
+        stateRegistry = app.settings["stateRegistry"]
+        tornado.ioloop.IOLoop.current().run_sync(lambda: warmState(stateRegistry))
+        warmTime = time.perf_counter() - warmStarted
+        metrics.observe("infinity_startup_seconds", warmTime, (("phase", "warm"),))
+
+        if isApiWorker:
+            logger.info("Starting Infinity API worker %d on port %s", taskID, self.apiPort)
+            server = tornado.httpserver.HTTPServer(app)
+            server.add_sockets(apiSockets)
+        else:
+            for apiSocket in apiSockets:
+                apiSocket.close()
+            logger.info("Starting the Infinity proxy service on port %s", self.port)
+            app.listen(self.port)
+        uptime = getProcessUptime()
+        if uptime is not None:
+            metrics.observe("infinity_startup_seconds", uptime, (("phase", "ready"),))
+            logger.info("Listening %.0f ms after the process started, with %d systems warmed in %.0f ms",
+                        uptime * 1e3, min(len(stateRegistry.stores), stateRegistry.maxCachedSystems), warmTime * 1e3)
+        ioloop = tornado.ioloop.IOLoop.current()
+        # Stop serving on SIGTERM as well, so the journals are closed before exiting
+        ioloop.asyncio_loop.add_signal_handler(signal.SIGTERM, ioloop.stop)
         try:
-            tornado.ioloop.IOLoop.current().start()
+            ioloop.start()
         except KeyboardInterrupt:
             logger.info("Interrupt received, stopping the Infinity proxy service")
-            tornado.ioloop.IOLoop.current().stop()
+            ioloop.stop()
+        ioloop.run_sync(stateRegistry.close)
 
     def getTornadoApp(self, appSettings):
         return tornado.web.Application([
@@ -73,19 +313,14 @@ class InfinityProxy:
             (r"/systems/(?P<systemID>\w*)", ConfigUpdateHandler),
             (r"/Alive", AliveHandler),
             (r"/weather/(?P<zipCode>.\w*)/forecast", WeatherUndergroundHandler),
+            (r"/metrics", MetricsHandler),
 
             #######################################################################
             # API for external apps to interface with the thermostat
             #######################################################################
-            (r"/api/(?P<fileName>system|status)\.?(?P<format>\w*)?/?", APIHandler),
-            # Special config handlers for lists contained in system.xml
-            (r"/api/config/wholeHouse/activities/activity/(?P<activityID>home|away|sleep|wake|manual)(?P<drilldownPath>.*)", APIHandler, {"xpathName": "WholeHouseActivity"}),
-            (r"/api/config/zones/(?P<optionalZone>zone/)?(?P<zoneID>[1-8])/activities/(?P<optionalActivity>activity/)?(?P<activityID>home|away|sleep|wake|manual)(?P<drilldownPath>.*)", APIHandler, {"xpathName": "ZoneActivity"}),
-            (r"/api/config/zones/(?P<OPTIONAL1>zone/)?(?P<zoneID>[1-8])/program/(?P<OPTIONAL2>day/)?(?P<dayID>Sunday|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday)/(?P<OPTIONAL3>period/)?(?P<periodID>[1-5])(?P<drilldownPath>.*)", APIHandler, {"xpathName": "ZoneProgramPeriod"}),
-            (r"/api/config/zones/(?P<OPTIONAL1>zone/)?(?P<zoneID>[1-8])/program/(?P<OPTIONAL2>day/)?(?P<dayID>Sunday|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday)(?P<drilldownPath>.*)", APIHandler, {"xpathName": "ZoneProgram"}),
-            (r"/api/config/zones/(?P<OPTIONAL1>zone/)?(?P<zoneID>[1-8])(?P<drilldownPath>.*)", APIHandler, {"xpathName": "Zone"}),
-            # Default config handler for system.xml
-            (r"/api/config(?P<drilldownPath>.*)", APIHandler, {"xpathName": "Config"}),
+            # Routes without a systemID act on the default system
+            *self.getApiRoutes(r"/api"),
+            *self.getApiRoutes(r"/api/(?P<systemID>\w+)"),
 
             #######################################################################
             # Catch-all for API calls we don't handle
@@ -99,105 +334,397 @@ class InfinityProxy:
 
         ], **appSettings)
 
+    def getApiWorkerApp(self, appSettings):
+        """Build the read-only API served by the worker processes in pre-fork mode."""
+        return tornado.web.Application([
+            *self.getApiRoutes(r"/api", readOnly=True),
+            *self.getApiRoutes(r"/api/(?P<systemID>\w+)", readOnly=True),
+            (r"/api/.*", APIHandler, {"action": "NotImplemented"}),
+            (r"/metrics", MetricsHandler),
+            (r"/.*", DefaultHandler)
+        ], **appSettings)
+
+    def getApiRoutes(self, prefix, readOnly=False):
+        routes = []
+        if not readOnly:
+            # Imported here so that tornado.websocket, and the HTTP client it imports, only load when the routes are built
+            from .streaming import ChangeStreamHandler, ChangeSocketHandler
+            routes += [
+                # Push notifications of status and config changes
+                (prefix + r"/events", ChangeStreamHandler),
+                (prefix + r"/stream", ChangeSocketHandler),
+                # Several config edits applied with a single write
+                (prefix + r"/config/batch/?", ConfigBatchHandler),
+                # Changes waiting for the thermostat to pull them
+                (prefix + r"/changes/?", ChangesHandler)
+            ]
+        return routes + [
+            (prefix + r"/(?P<fileName>system|status)\.?(?P<format>\w*)?/?", APIHandler),
+            (prefix + r"/history/?", HistoryHandler),
+            *[(prefix + pattern, APIHandler, {"xpathName": xpathName}) for pattern, xpathName in CONFIG_ROUTES]
+        ]
+
 
 class BaseHandler(tornado.web.RequestHandler):
     """Provide common attributes and methods for all requests."""
 
+    requiresState = True
+    # Only the thermostat protocol routes register new systems
+    createsState = False
+
     def initialize(self, **kwargs):
         tornado.web.RequestHandler.initialize(self)
         self.handlerConfig = kwargs
+        self.stateRegistry = self.application.settings.get("stateRegistry")
+        self.changeBroker = self.application.settings.get("changeBroker")
         self.stateDirectory = self.application.settings.get("stateDirectory")
-        self.systemPath = os.path.join(self.stateDirectory, FILE_SYSTEM)
-        self.statusPath = os.path.join(self.stateDirectory, FILE_STATUS)
-        self.changePath = os.path.join(self.stateDirectory, FILE_CHANGEFLAG)
+        self.stateStore = None
+        self.entityTag = None
+        self.requestSize = 0
+        self.responseSize = 0
         logger.debug("%s: %s", self.request.method, self.request.uri)
 
-    def writeDataToFile(self, data, filePath):
-        try:
-            with open(filePath, 'wb') as f:
-                f.write(data)
-        except Exception as e:
-            logger.error("Failed to write '%s': %s'", filePath, e)
-            raise e
-
-    def readDataFromFile(self, filePath):
-        try:
-            with open(filePath, 'rb') as f:
-                data = f.read()
-        except Exception as e:
-            logger.error("Failed to read '%s': %s'", filePath, e)
-            return ""
-        return data
-
-    def configIsChanged(self):
-        return os.path.exists(self.changePath)
-
-    def setChangeFlag(self, enabled):
-        if bool(enabled):
-            self.writeDataToFile(b"true", self.changePath)
+    def prepare(self):
+        """Select the state for the system named in the route, or the default system if there is none."""
+        if self.application.settings.get("readOnly") and self.request.method not in ("GET", "HEAD"):
+            raise tornado.web.HTTPError(405, "API workers are read-only; send updates to the main proxy port")
+        systemID = self.path_kwargs.get("systemID")
+        if systemID and self.createsState:
+            self.stateStore = self.stateRegistry.getStore(systemID)
+        elif systemID:
+            self.stateStore = self.stateRegistry.findStore(systemID)
+            if self.stateStore is None and self.requiresState:
+                raise tornado.web.HTTPError(404, "Unknown thermostat system '%s'" % systemID)
         else:
-            os.remove(self.changePath)
+            self.stateStore = self.stateRegistry.getDefault()
+        if self.stateStore is not None:
+            self.stateDirectory = self.stateStore.stateDirectory
+        elif self.requiresState:
+            raise tornado.web.HTTPError(404, "No thermostat system is known")
+        self.systemPath = os.path.join(self.stateDirectory, FILE_SYSTEM)
+        self.statusPath = os.path.join(self.stateDirectory, FILE_STATUS)
+
+    def getRouteName(self):
+        """Name this request's route for metrics, without the unbounded parts of its URL."""
+        return self.__class__.__name__
+
+    def write(self, chunk):
+        tornado.web.RequestHandler.write(self, chunk)
+        if isinstance(chunk, (bytes, str)):
+            self.responseSize += len(chunk)
+
+    def on_finish(self):
+        labels = (("route", self.getRouteName()), ("method", self.request.method))
+        metrics.increment("infinity_http_requests_total", labels + (("status", self.get_status()),))
+        metrics.observe("infinity_http_request_duration_seconds", self.request.request_time(), labels)
+        metrics.observe("infinity_http_request_size_bytes", len(self.request.body or b"") or self.requestSize, labels, SIZE_BUCKETS)
+        metrics.observe("infinity_http_response_size_bytes", self.responseSize, labels, SIZE_BUCKETS)
+
+    async def getChangeTracker(self):
+        return await loadChangeTracker(self.stateStore)
+
+    async def publishChanges(self, fileName, source):
+        """Send the elements of a state file that changed since it was last published to any streaming clients."""
+        if self.changeBroker is not None and self.changeBroker.hasSubscribers(self.stateStore.systemID):
+            root = await self.stateStore.getRoot(fileName)
+            if root is not None:
+                self.changeBroker.publishElement(self.stateStore.systemID, source, root)
+
+    def getJournal(self):
+        """Return the journal of the selected system, or None if journaling is disabled."""
+        journalSize = self.settings.get("journalSize", 0)
+        if journalSize <= 0 or self.settings.get("readOnly"):
+            return None
+        if self.stateStore.journal is None:
+            self.stateStore.journal = Journal(os.path.join(self.stateStore.stateDirectory, DIR_JOURNAL), self.stateStore.writer, journalSize,
+                                              compress=self.settings.get("compressJournal", True))
+        return self.stateStore.journal
+
+    def appendToJournal(self, kind, name, body):
+        """Journal a change, returning an awaitable that resolves once the record is written.
+
+        The record is queued on the writer thread straight away, so it is written before any state write
+        queued after this call, and the caller can await it once the state has been saved.
+        """
+        journal = self.getJournal()
+        return asyncio.ensure_future(self.waitForJournal(name, journal.append(kind, name, body, time.time()) if journal is not None else None))
+
+    @staticmethod
+    async def waitForJournal(name, future):
+        # Failures are only logged, since the state files remain the primary copy
+        if future is not None:
+            try:
+                await future
+            except Exception as e:
+                logger.warning("Failed to journal '%s': %s", name, e)
+
+    def getHistoryStore(self):
+        if self.stateStore.history is None:
+            self.stateStore.history = HistoryStore(os.path.join(self.stateStore.stateDirectory, DIR_HISTORY), self.stateStore.writer)
+        return self.stateStore.history
 
     def formatOutgoingXml(self, rootElement):
-        xmlString = ET.tostring(rootElement)
-        xmlString = xmlString.replace(b" />", b"/>")  # Remove the extra space that ElementTree inserts in tag name of empty elements
-        xmlString = re.sub(b"(\\s\\s+)|\\n", b"", xmlString)  # Strip space/tab formatting
-        return xmlString
+        return formatOutgoingXml(rootElement)
 
     def writeResponse(self, data, outputType=TYPE_XML):
         response = ""
 
-        if isinstance(data, ET.Element):
-            xmlString = self.formatOutgoingXml(data)
+        if isinstance(data, ET.Element) and outputType == TYPE_JSON:
+            response = self.elementToJson(data)
+        elif isinstance(data, (ET.Element, bytes)):
+            xmlString = self.formatOutgoingXml(data) if isinstance(data, ET.Element) else data
             if outputType == TYPE_XML:
                 response = xmlString
             elif outputType == TYPE_JSON:
+                import xmltodict
                 response = json.dumps(xmltodict.parse(xmlString))
             else:
-                response = ET.tostring(data)
+                response = xmlString
         elif isinstance(data, dict):
             jsonString = json.dumps(data)
             if outputType == TYPE_JSON:
                 response = jsonString
             elif outputType == TYPE_XML:
+                import xmltodict
                 response = xmltodict.unparse(data)
         else:
             outputType = TYPE_TEXT
             if data is None:
                 data = ""
             response = str(data)
+        self.writeSerializedResponse(response, outputType)
+
+    def writeSerializedResponse(self, response, outputType):
+        """Write a response body that has already been serialized."""
         self.set_header('Content-Type', outputType)
         self.write(response)
 
+    async def checkNotModified(self, fileName):
+        """Set the validators of a state file and answer 304 if the client's copy is still current.
+
+        Only the file's generation and mtime are consulted, so a revalidation never parses or serializes the file.
+        """
+        entry = await self.stateStore.getEntry(fileName)
+        if entry is None:
+            return False
+        self.entityTag = self.stateStore.getETag(fileName)
+        self.set_header("Etag", self.entityTag)
+        if entry.mtime is not None:
+            self.set_header("Last-Modified", datetime.datetime.fromtimestamp(entry.mtime, datetime.timezone.utc))
+        if self.request.headers.get("If-None-Match"):
+            notModified = self.check_etag_header()
+        else:
+            notModified = entry.mtime is not None and self.isModifiedSince(entry.mtime) is False
+        if notModified:
+            self.set_status(304)
+        return notModified
+
+    def isModifiedSince(self, mtime):
+        """Compare an mtime with the If-Modified-Since header, returning None if there is no usable header."""
+        try:
+            since = email.utils.parsedate_to_datetime(self.request.headers.get("If-Modified-Since", ""))
+        except (TypeError, ValueError):
+            return None
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return int(mtime) > since.timestamp()
+
+    async def writeVersionedResponse(self, fileName, cacheKey, response, outputType):
+        """Write a body derived from a state file, gzipped for clients that accept it.
+
+        The compressed body is cached alongside the file's other derived values, keyed by the entity tag
+        that checkNotModified() sent, so it is compressed once per generation.
+        """
+        self.set_header("Vary", "Accept-Encoding")
+        if len(response) >= GZIP_MIN_LENGTH and acceptsGzip(self.request.headers.get("Accept-Encoding", "")):
+            compressed = await self.stateStore.getDerived(fileName, ("gzip", self.entityTag) + cacheKey,
+                                                          lambda root: gzip.compress(response, GZIP_LEVEL))
+            if compressed is not None:
+                self.set_header("Content-Encoding", "gzip")
+                response = compressed
+        self.writeSerializedResponse(response, outputType)
+
+    @staticmethod
+    def elementToJson(element):
+        if element is None:
+            return None
+        with metrics.timer("infinity_json_serialize_seconds"):
+            return json.dumps(elementToDict(element)).encode()
+
+
+@tornado.web.stream_request_body
+class UploadHandler(BaseHandler):
+    """Receive a thermostat upload, decoding its data form field as the body arrives instead of buffering it.
+
+    Subclasses are handed the decoded data a chunk at a time in consumeData(), and call finishUpload()
+    from post() once the body is complete.  Bodies larger than the maxUploadSize setting are rejected.
+    Subclasses that set journalKind feed the data to journalRecord as well.
+    """
+
+    createsState = True
+    journalKind = None
+
+    def getJournalName(self):
+        raise NotImplementedError()
+
+    def prepare(self):
+        BaseHandler.prepare(self)
+        self.maxUploadSize = self.settings.get("maxUploadSize", DEFAULT_MAXUPLOADSIZE)
+        self.uploadError = None
+        self.bufferedBody = []
+        journal = self.getJournal() if self.journalKind is not None else None
+        self.journalRecord = journal.startRecord(self.journalKind, self.getJournalName(), time.time()) if journal is not None else None
+        self.request.connection.set_max_body_size(self.maxUploadSize)
+        if int(self.request.headers.get("Content-Length", 0)) > self.maxUploadSize:
+            raise tornado.web.HTTPError(413, "Uploads are limited to %d bytes" % self.maxUploadSize)
+        if self.request.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            self.formDecoder = FormFieldDecoder("data")
+        else:
+            # Multipart bodies are rare enough to be buffered and parsed by Tornado
+            self.formDecoder = None
+
+    async def data_received(self, chunk):
+        if self.uploadError is not None:
+            return
+        self.requestSize += len(chunk)
+        try:
+            if self.requestSize > self.maxUploadSize:
+                raise tornado.web.HTTPError(413, "Uploads are limited to %d bytes" % self.maxUploadSize)
+            if self.formDecoder is None:
+                self.bufferedBody.append(chunk)
+                return
+            data = self.formDecoder.feed(chunk)
+            if data:
+                await self.consumeData(data)
+        except Exception as e:
+            # Errors can't be sent until the body has been read, so keep the first one for finishUpload()
+            self.uploadError = e
+
+    async def consumeData(self, data):
+        raise NotImplementedError()
+
+    async def finishUpload(self):
+        """Consume the rest of the data field, raising any error from earlier in the upload."""
+        if self.uploadError is not None:
+            raise self.uploadError
+        if self.formDecoder is None:
+            arguments = {}
+            tornado.httputil.parse_body_arguments(self.request.headers.get("Content-Type", ""), b"".join(self.bufferedBody), arguments, {}, self.request.headers)
+            self.bufferedBody = []
+            if "data" not in arguments:
+                raise tornado.web.MissingArgumentError("data")
+            data = arguments["data"][0]
+        else:
+            data, found = self.formDecoder.close()
+            if not found:
+                raise tornado.web.MissingArgumentError("data")
+        if data:
+            await self.consumeData(data)
+
+    def finishJournalRecord(self):
+        """Queue the journal record of a complete upload, like appendToJournal()."""
+        record, self.journalRecord = self.journalRecord, None
+        return asyncio.ensure_future(self.waitForJournal(self.getJournalName(), self.getJournal().appendRecord(record) if record is not None else None))
+
+    def discardJournalRecord(self):
+        if getattr(self, "journalRecord", None) is not None:
+            self.getJournal().discardRecord(self.journalRecord)
+            self.journalRecord = None
+
+    def on_connection_close(self):
+        self.discardJournalRecord()
+        BaseHandler.on_connection_close(self)
+
+    def on_finish(self):
+        self.discardJournalRecord()
+        BaseHandler.on_finish(self)
+
+
+class StagedUploadHandler(UploadHandler):
+    """Stream an upload into a temp file beside its state file, and rename it into place once complete."""
+
+    journalKind = RECORD_UPLOAD
+
+    def getFileName(self):
+        raise NotImplementedError()
+
+    def getJournalName(self):
+        return self.getFileName()
+
+    def prepare(self):
+        UploadHandler.prepare(self)
+        self.stagedFile = self.stateStore.stageFile(self.getFileName())
+
+    async def consumeData(self, data):
+        await self.stateStore.writer.run(self.writeChunk, self.stagedFile, self.journalRecord, data)
+
+    @staticmethod
+    def writeChunk(stagedFile, journalRecord, data):
+        stagedFile.write(data)
+        if journalRecord is not None:
+            journalRecord.feed(data)
+
+    async def saveUpload(self):
+        await self.finishUpload()
+        journaled = self.finishJournalRecord()
+        stagedFile, self.stagedFile = self.stagedFile, None
+        await self.stateStore.write(self.getFileName(), stagedFile)
+        await journaled
+
+    def discardUpload(self):
+        if getattr(self, "stagedFile", None) is not None:
+            self.stateStore.writer.run(self.stagedFile.discard)
+            self.stagedFile = None
+
+    def on_connection_close(self):
+        self.discardUpload()
+        UploadHandler.on_connection_close(self)
+
+    def on_finish(self):
+        self.discardUpload()
+        UploadHandler.on_finish(self)
+
 
-class ConfigUpdateHandler(BaseHandler):
+class ConfigUpdateHandler(StagedUploadHandler):
     """Process configuration changes that were initiated on the thermostat."""
 
-    def post(self, systemID):
+    def getFileName(self):
+        return FILE_SYSTEM
+
+    async def post(self, systemID):
         """Write POSTed thermostat configuration to the state directory."""
 
-        data = self.request.arguments["data"][0]
-        self.writeDataToFile(data, self.systemPath)
+        await self.saveUpload()
+        await self.publishChanges(FILE_SYSTEM, "config")
 
 
 class StatusUpdateHandler(BaseHandler):
     """Process status updates generated by the thermostat."""
 
-    def post(self, systemID):
+    createsState = True
+
+    async def post(self, systemID):
         """Write POSTed XML thermostat state to the state directory, and generate a response."""
 
         if "data" not in self.request.arguments:
             return
         data = self.request.arguments["data"][0]
-        self.writeDataToFile(data, self.statusPath)
+        journaled = self.appendToJournal(RECORD_UPLOAD, FILE_STATUS, data)
+        await self.stateStore.write(FILE_STATUS, data)
+        await journaled
+        await self.publishChanges(FILE_STATUS, "status")
+        try:
+            await self.getHistoryStore().record(await self.stateStore.getRoot(FILE_STATUS))
+        except Exception as e:
+            logger.warning("Failed to record status history: %s", e)
 
-        elementTextUpdates = {"timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
-        if self.configIsChanged():
-            elementTextUpdates.update({"serverHasChanges": "true", "configHasChanges": "true"})
-        responseXml = self.generateResponseXml(systemID, elementTextUpdates)
-        self.writeResponse(responseXml, TYPE_XML)
+        changeTracker = await self.getChangeTracker()
+        elementTextUpdates = {"timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), **changeTracker.elementTextUpdates}
+        responseTemplate = getStatusResponseTemplate(systemID)
+        self.writeResponse(responseTemplate.render(elementTextUpdates), TYPE_XML)
 
-    def generateResponseXml(self, systemID, elementTextUpdates={}, hostname="www.api.ing.carrier.com"):
+    @staticmethod
+    def generateResponseXml(systemID, elementTextUpdates={}, hostname="www.api.ing.carrier.com"):
 
         # This can be copy/pasted from an actual response in the event of future updates to the protocol
         sampleXML = """
@@ -245,73 +772,206 @@ class StatusUpdateHandler(BaseHandler):
         return root
 
 
+class StatusResponseTemplate:
+    """Pre-serialized status response for one system, with slots for the element text that changes per ping.
+
+    render() produces the same bytes as formatting the output of StatusUpdateHandler.generateResponseXml().
+    """
+
+    slotPattern = re.compile(b"\\[\\[slot:(\\w+)\\]\\]")
+
+    def __init__(self, systemID, hostname="www.api.ing.carrier.com"):
+        root = StatusUpdateHandler.generateResponseXml(systemID, hostname=hostname)
+        self.defaults = {}
+        for element in root:
+            if len(element) == 0 and element.text is not None and element.tag not in self.defaults:
+                self.defaults[element.tag] = self.encodeText(element.text or "")
+                element.text = "[[slot:{}]]".format(element.tag)
+
+        # Alternating static chunks and slot names, starting and ending with a static chunk
+        parts = self.slotPattern.split(formatOutgoingXml(root))
+        self.chunks = parts[0::2]
+        self.slots = [slot.decode() for slot in parts[1::2]]
+
+    def render(self, elementTextUpdates={}):
+        pieces = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            value = elementTextUpdates.get(slot)
+            pieces.append(self.defaults[slot] if value is None else self.encodeText(value))
+            pieces.append(chunk)
+        return b"".join(pieces)
+
+    @staticmethod
+    def encodeText(value):
+        text = escape(str(value)).encode("ascii", "xmlcharrefreplace")
+        return re.sub(b"(\\s\\s+)|\\n", b"", text)  # Match the whitespace stripping in formatOutgoingXml
+
+
+@functools.lru_cache(maxsize=256)
+def getStatusResponseTemplate(systemID, hostname="www.api.ing.carrier.com"):
+    return StatusResponseTemplate(systemID, hostname)
+
+
 class ConfigRequestHandler(BaseHandler):
     """Send the local system config file back to the thermostat after it has been notified of a config change."""
 
-    def get(self, systemID, hostname="www.api.ing.carrier.com", version="1.29"):
+    createsState = True
+
+    async def get(self, systemID, hostname="www.api.ing.carrier.com", version="1.29"):
         """Reply with the local system XML, updated with ATOM elements and a current timestamp."""
 
+        # Everything but the timestamp is serialized once per change to system.xml
+        responseParts = await self.stateStore.getDerived(FILE_SYSTEM, ("configResponse", systemID, hostname, str(version)),
+                                                         lambda root: self.buildResponseParts(root, systemID, hostname, version))
+        if responseParts is None:
+            raise tornado.web.HTTPError(404, "No system config has been received from the thermostat")
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ").encode()
+        self.writeSerializedResponse(responseParts[0] + timestamp + responseParts[1], TYPE_XML)
+        (await self.getChangeTracker()).markPulled("config")
+
+    @staticmethod
+    def buildResponseParts(cachedRoot, systemID, hostname, version):
+        """Serialize the config response around a placeholder timestamp, returning the XML before and after it."""
         namespace = {"atom": "http://www.w3.org/2005/Atom"}
         ET.register_namespace("atom", namespace["atom"])
-        root = ET.parse(self.systemPath).getroot()
-        configElement = root.find("./config")
+        # The cached tree is shared, so build a new system/config shell around its untouched children
+        cachedConfig = cachedRoot.find("./config")
+        root = ET.Element(cachedRoot.tag, cachedRoot.attrib)
+        root.text = cachedRoot.text
+        configElement = ET.Element(cachedConfig.tag, cachedConfig.attrib)
+        configElement.text = cachedConfig.text
+        configElement.extend(cachedConfig)
+        for child in cachedRoot:
+            root.append(configElement if child is cachedConfig else child)
         configElement.set("version", str(version))
         atomSelfElement = ET.Element("{%s}link" % namespace["atom"], {"rel": "self", "href": "http://%s/systems/%s/config" % (hostname, systemID)})
         atomHrefElement = ET.Element("{%s}link" % namespace["atom"], {"rel": "http://%s/rels/system" % (hostname), "href": "http://%s/systems/%s" % (hostname, systemID)})
         timestampElement = ET.Element("timestamp")
-        timestampElement.text = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        timestampElement.text = TIMESTAMP_SLOT
         configElement.insert(0, timestampElement)
         configElement.insert(0, atomHrefElement)
         configElement.insert(0, atomSelfElement)
-        self.writeResponse(root, TYPE_XML)
-        self.setChangeFlag(False)
+        head, tail = formatOutgoingXml(root).split(TIMESTAMP_SLOT.encode(), 1)
+        return head, tail
 
 
-class NotificationUpdateHandler(BaseHandler):
+class NotificationUpdateHandler(UploadHandler):
     """Process notification messages sent after the thermostat was updated."""
 
-    def post(self, systemID):
-        data = self.request.arguments["data"][0]
-        root = ET.fromstring(data)
-        notificationType = root.find("./notification/type").text
-        code = root.find("./notification/code").text
-        message = root.find("./notification/message").text
-        timestamp = root.find("./notification/timestamp").text
-
-        if code == "200":
-            logger.info("Received %s notification: (%s) %s at %s", notificationType, code, message, timestamp)
+    journalKind = RECORD_NOTIFICATION
+
+    def getJournalName(self):
+        return "notifications"
+
+    def prepare(self):
+        UploadHandler.prepare(self)
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.elementPath = []
+        self.notification = Notification()
+
+    async def consumeData(self, data):
+        if self.journalRecord is not None:
+            await self.stateStore.writer.run(self.journalRecord.feed, data)
+        self.parser.feed(data)
+        self.readEvents()
+
+    def readEvents(self):
+        """Read the fields of the first notification and the changes of all of them, clearing elements once read."""
+        for event, element in self.parser.read_events():
+            if event == "start":
+                self.elementPath.append(element.tag)
+                continue
+            path = self.elementPath[1:]
+            self.elementPath.pop()
+            if path == ["notification", "changes", "change"]:
+                change = Change(dict(element.attrib), element.text)
+                self.notification.changes.append(change)
+                logger.debug("Change processed: %s", change.toDict())
+                element.clear()
+            elif len(path) == 2 and path[0] == "notification" and path[1] in Notification.fields:
+                if getattr(self.notification, path[1]) is None:
+                    setattr(self.notification, path[1], element.text)
+            elif path == ["notification"]:
+                element.clear()
+
+    async def post(self, systemID):
+        await self.finishUpload()
+        await self.finishJournalRecord()
+        self.parser.close()
+        self.readEvents()
+        notification = self.notification
+
+        if notification.code == "200":
+            logger.info("Received %s notification: (%s) %s at %s", notification.type, notification.code, notification.message, notification.timestamp)
         else:
-            logger.error("Received %s notification: (%s) %s at %s", notificationType, code, message, timestamp)
+            logger.error("Received %s notification: (%s) %s at %s", notification.type, notification.code, notification.message, notification.timestamp)
 
-        changes = []
-        changeElements = root.findall("./notification/changes/change")
-        for changeElement in changeElements:
-            change = {"attributes": changeElement.attrib, "text": changeElement.text}
-            changes.append(change)
-            logger.debug("Change processed: %s", change)
+        if self.changeBroker is not None:
+            self.changeBroker.publish(self.stateStore.systemID, dict(notification.toDict(), source="notification"))
 
 
 class AliveHandler(BaseHandler):
     """Respond to periodic checks by the thermostat to confirm if the server is alive."""
 
+    requiresState = False
+
     def get(self):
         self.write("alive")
 
 
-class LocalSaveHandler(BaseHandler):
+class LocalSaveHandler(StagedUploadHandler):
     """Save POST requests to the local state directory."""
 
-    def post(self, systemID):
-        data = self.request.arguments["data"][0]
-        fileName = "{}.xml".format(os.path.basename(self.request.uri))
-        filePath = os.path.join(self.stateDirectory, fileName)
-        self.writeDataToFile(data, filePath)
+    def getRouteName(self):
+        return "{}:{}".format(self.__class__.__name__, os.path.basename(self.request.path))
+
+    def getFileName(self):
+        return "{}.xml".format(os.path.basename(self.request.path))
+
+    async def post(self, systemID):
+        await self.saveUpload()
+
+
+class ForecastCache:
+    """Built forecast responses, kept for a limited time and shared by concurrent requests for the same forecast."""
+
+    def __init__(self, maxSize=256):
+        self.maxSize = maxSize
+        self.responses = {}
+        self.pending = {}
+
+    def get(self, key, ttl, build):
+        """Return an awaitable for the cached response, starting a single build() if it is missing or expired."""
+        cached = self.responses.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(cached[1])
+            return future
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self.refresh(key, ttl, build))
+            self.pending[key] = pending
+        return pending
+
+    async def refresh(self, key, ttl, build):
+        try:
+            response = await build()
+        finally:
+            del self.pending[key]
+        now = time.monotonic()
+        if len(self.responses) >= self.maxSize:
+            self.responses = {k: v for k, v in self.responses.items() if v[0] > now}
+        if len(self.responses) < self.maxSize:
+            self.responses[key] = (now + ttl, response)
+        return response
 
 
 class WeatherUndergroundHandler(BaseHandler):
     """Reply to weather forecast requests by transforming data from Weather Underground."""
 
-    def get(self, zipCode, hostName="www.api.ing.carrier.com", version="1.29", ping=240):
+    requiresState = False
+
+    async def get(self, zipCode, hostName="www.api.ing.carrier.com", version="1.29", ping=240):
         apiKey = self.application.settings.get("wundergroundApiKey")
         if len(apiKey) == 0:
             logger.warning("No Weather Underground API key provided.  Aborting request for forecast.")
@@ -319,8 +979,25 @@ class WeatherUndergroundHandler(BaseHandler):
             self.write("Error retrieving forecast: No Weather Underground API key provided")
             return
 
-        forecastUrl = "http://api.wunderground.com/api/{}/forecast10day/q/{}.xml".format(apiKey, zipCode)
-        wuXmlString = urllib.request.urlopen(forecastUrl).read()
+        # Forecasts are cached for one ping interval, and concurrent requests for a zip code share one upstream fetch
+        forecastCache = self.application.settings.get("forecastCache")
+        from tornado.httpclient import HTTPClientError
+        try:
+            response = await forecastCache.get((zipCode, hostName, version), ping,
+                                               lambda: self.buildForecast(apiKey, zipCode, hostName, version, ping))
+        except (HTTPClientError, OSError, ET.ParseError) as e:
+            logger.error("Failed to retrieve forecast for '%s': %s", zipCode, e)
+            self.set_status(502, "Weather Underground request failed")
+            self.write("Error retrieving forecast: {}".format(e))
+            return
+        self.writeResponse(response, TYPE_XML)
+
+    async def buildForecast(self, apiKey, zipCode, hostName, version, ping):
+        baseUrl = self.application.settings.get("weatherBaseUrl", DEFAULT_WEATHERBASEURL).rstrip("/")
+        forecastUrl = "{}/{}/forecast10day/q/{}.xml".format(baseUrl, apiKey, zipCode)
+        from tornado.httpclient import AsyncHTTPClient
+        wuResponse = await AsyncHTTPClient().fetch(forecastUrl)
+        wuXmlString = wuResponse.body
         wuForecasts = ET.fromstring(wuXmlString).findall("./forecast/simpleforecast/forecastdays/forecastday")
 
         namespace = {"atom": "http://www.w3.org/2005/Atom"}
@@ -351,7 +1028,7 @@ class WeatherUndergroundHandler(BaseHandler):
             dayElement.append(self.createElement("pop", text=pop))
             forecastElement.append(dayElement)
 
-        self.writeResponse(forecastElement, TYPE_XML)
+        return self.formatOutgoingXml(forecastElement)
 
     def createElement(self, name, attrib={}, text=""):
         element = ET.Element(name, attrib)
@@ -391,6 +1068,8 @@ class WeatherUndergroundHandler(BaseHandler):
 class DefaultHandler(BaseHandler):
     """Fallback handler for anything not picked up elsewhere."""
 
+    requiresState = False
+
     def get(self):
         logger.warning("Unhandled request: %s %s", self.request.method, self.request.path)
 
@@ -403,58 +1082,245 @@ class APIHandler(BaseHandler):
 
     formatToType = {"xml": TYPE_XML, "json": TYPE_JSON}
 
-    def getXpath(self, xpathName, replacements):
+    def getRouteName(self):
+        routeName = self.handlerConfig.get("xpathName") or self.path_kwargs.get("fileName") or self.handlerConfig.get("action")
+        return "{}:{}".format(self.__class__.__name__, routeName) if routeName else self.__class__.__name__
 
-        xpathMap = {
-            "Config": "./config{drilldownPath}",
-            "Zone": "./config/zones/zone[@id='{zoneID}']{drilldownPath}",
-            "ZoneActivity": "./config/zones/zone[@id='{zoneID}']/activities/activity[@id='{activityID}']{drilldownPath}",
-            "ZoneProgram": "./config/zones/zone[@id='{zoneID}']/program/day[@id='{dayID}']{drilldownPath}",
-            "ZoneProgramPeriod": "./config/zones/zone[@id='{zoneID}']/program/day[@id='{dayID}']/period[@id='{periodID}']{drilldownPath}",
-            "WholeHouseActivity": "./config/wholeHouse/activities/activity[@id='{activityID}']{drilldownPath}"
-        }
-        xpath = xpathMap[xpathName].format_map(replacements)
-        return xpath
+    async def getConfigIndex(self):
+        """Return the index of system.xml, which is rebuilt only when the thermostat sends a new config."""
+        return await self.stateStore.getDerived(FILE_SYSTEM, "configIndex", ConfigIndex)
 
-    def get(self, **pathVars):
+    async def getSystemModel(self):
+        """Return the model of system.xml, which keeps the serialized form of its zones between edits."""
+        return await self.stateStore.getDerived(FILE_SYSTEM, "model", System)
+
+    async def get(self, **pathVars):
 
         if self.handlerConfig.get("xpathName") is not None:
-            root = ET.parse(self.systemPath).getroot()
-            xpath = self.getXpath(self.handlerConfig.get("xpathName"), pathVars)
-            if xpath is None or xpath == "":
-                xpath = "."
-            foundElement = root.find(xpath)
-            self.writeResponse(foundElement, TYPE_JSON)
+            if await self.checkNotModified(FILE_SYSTEM):
+                return
+            configIndex = await self.getConfigIndex()
+            if configIndex is None:
+                raise tornado.web.HTTPError(404, "No system config has been received from the thermostat")
+            anchorKey = ConfigIndex.getAnchorKey(self.handlerConfig.get("xpathName"), pathVars)
+            drilldownPath = pathVars.get("drilldownPath", "")
+            # JSON projections are memoized until the next change to system.xml
+            cacheKey = ("json", anchorKey, drilldownPath)
+            jsonString = await self.stateStore.getDerived(FILE_SYSTEM, cacheKey,
+                                                          lambda root: self.elementToJson(configIndex.find(anchorKey, drilldownPath)))
+            if jsonString is None:
+                self.writeResponse(None, TYPE_JSON)
+            else:
+                await self.writeVersionedResponse(FILE_SYSTEM, cacheKey, jsonString, TYPE_JSON)
         else:
             outputFormat = self.formatToType.get(pathVars["format"], TYPE_JSON)
-            fileNameNoExt = os.path.basename(self.request.uri).split(".")[0]
-            filePath = "{}.xml".format(os.path.join(self.stateDirectory, fileNameNoExt))
-            data = self.readDataFromFile(filePath)
-            root_element = ET.fromstring(data)
-            self.writeResponse(root_element, outputFormat)
+            fileName = "{}.xml".format(pathVars["fileName"])
+            if await self.checkNotModified(fileName):
+                return
+            if outputFormat == TYPE_JSON:
+                cacheKey = ("json", ".")
+                response = await self.stateStore.getDerived(fileName, cacheKey, self.elementToJson)
+            else:
+                cacheKey = ("xml",)
+                response = await self.stateStore.getSerialized(fileName)
+            if response is None:
+                raise tornado.web.HTTPError(404, "No %s data has been received from the thermostat" % pathVars["fileName"])
+            await self.writeVersionedResponse(fileName, cacheKey, response, outputFormat)
 
-    def post(self, **pathVars):
+    async def post(self, **pathVars):
 
         updates = json.loads(self.request.body)
-        xpath = self.getXpath(self.handlerConfig.get("xpathName"), pathVars)
-        self.updateSystemConfig(xpath, updates)
-
-    def updateSystemConfig(self, baseXpath, newValues):
-        root = ET.parse(self.systemPath).getroot()
-        for relativePath, newValue in newValues.items():
-            fullXpath = "{}/{}".format(baseXpath, relativePath)
-            foundElement = root.find(fullXpath)
-            if foundElement is not None:
-                if newValue is None or newValue == "null" or len(str(newValue)) == 0:
-                    newValue = ""
-                foundElement.text = str(newValue)
-        xmlString = self.formatOutgoingXml(root)
+        anchorKey = ConfigIndex.getAnchorKey(self.handlerConfig.get("xpathName"), pathVars)
+        await self.updateSystemConfig(anchorKey, pathVars.get("drilldownPath", ""), updates)
+
+    async def updateSystemConfig(self, anchorKey, drilldownPath, newValues):
+        edits = [(relativePath, anchorKey, "{}/{}".format(drilldownPath, relativePath), newValue) for relativePath, newValue in newValues.items()]
+        return await self.applyConfigEdits(edits)
+
+    async def applyConfigEdits(self, edits, strict=False):
+        """Apply (name, anchorKey, drilldownPath, value) edits to system.xml, returning the number of elements changed.
+
+        The config is only written, and the thermostat only told to pull it, if some element text actually changed.
+        In strict mode nothing is applied unless every edit refers to an existing element.
+        """
+        configIndex = await self.getConfigIndex()
+        if configIndex is None:
+            raise tornado.web.HTTPError(404, "No system config has been received from the thermostat")
+        root = await self.stateStore.getRoot(FILE_SYSTEM)
+
+        resolvedEdits = []
+        missing = []
+        for name, anchorKey, drilldownPath, newValue in edits:
+            foundElement = configIndex.find(anchorKey, drilldownPath)
+            if foundElement is None:
+                missing.append(name)
+                continue
+            if newValue is None or newValue == "null" or len(str(newValue)) == 0:
+                newValue = ""
+            resolvedEdits.append((foundElement, str(newValue), anchorKey, drilldownPath))
+        if strict and missing:
+            raise tornado.web.HTTPError(400, "Config elements not found: %s" % ", ".join(missing))
+
+        systemModel = await self.getSystemModel()
+        changedEdits = []
+        oldValues = []
+        for foundElement, newValue, anchorKey, drilldownPath in resolvedEdits:
+            if (foundElement.text or "") != newValue:
+                oldValues.append((foundElement, foundElement.text))
+                foundElement.text = newValue
+                changedEdits.append((anchorKey, drilldownPath, newValue))
+                # Edits below a zone only invalidate that zone's serialized XML
+                if anchorKey[0].startswith("Zone"):
+                    systemModel.markChanged(anchorKey[1])
+                else:
+                    systemModel.invalidate()
+        if not changedEdits:
+            return 0
+        journaled = self.appendToJournal(RECORD_EDITS, FILE_SYSTEM, encodeEdits(changedEdits))
+        try:
+            with metrics.timer("infinity_xml_serialize_seconds", (("file", FILE_SYSTEM),)):
+                serialized = systemModel.serialize()
+            await self.stateStore.updateRoot(FILE_SYSTEM, root, keepDerived=("configIndex", "model"), serialized=serialized)
+        except Exception as e:
+            logger.error("Failed to save system config, reverting %d edits: %s", len(changedEdits), e)
+            await self.revertConfigEdits(changedEdits, oldValues)
+            await journaled
+            raise tornado.web.HTTPError(500, "Failed to save system config")
         try:
-            self.writeDataToFile(xmlString, self.systemPath)
-            self.setChangeFlag(True)
+            await (await self.getChangeTracker()).markChanged("config")
+            await self.publishChanges(FILE_SYSTEM, "config")
         except Exception as e:
-            logger.warning("Failed to update system config: %s", e)
+            logger.warning("Failed to notify the thermostat of the config change: %s", e)
+        await journaled
+        return len(changedEdits)
+
+    async def revertConfigEdits(self, changedEdits, oldValues):
+        """Restore the element text replaced by edits that could not be saved, so memory matches system.xml on disk again.
+
+        The edits are already journaled, so they are undone there as well, or recovery would apply them after a restart.
+        """
+        revertedEdits = []
+        for (anchorKey, drilldownPath, newValue), (foundElement, oldValue) in reversed(list(zip(changedEdits, oldValues))):
+            foundElement.text = oldValue
+            revertedEdits.append((anchorKey, drilldownPath, oldValue or ""))
+        self.stateStore.invalidate(FILE_SYSTEM)
+        await self.appendToJournal(RECORD_EDITS, FILE_SYSTEM, encodeEdits(revertedEdits))
+
+
+class ConfigBatchHandler(APIHandler):
+    """Apply a list of config edits atomically, with a single write of system.xml."""
+
+    configRoutes = [(re.compile(pattern + "$"), xpathName) for pattern, xpathName in CONFIG_ROUTES]
+
+    def get(self, **pathVars):
+        raise tornado.web.HTTPError(405)
+
+    async def post(self, **pathVars):
+        """Accept [{"path": ..., "value": ...}, ...] or {path: value, ...}, with paths in the form of the config API routes."""
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Request body is not valid JSON")
+        if isinstance(body, dict):
+            body = [{"path": path, "value": value} for path, value in body.items()]
+        if not isinstance(body, list) or not all(isinstance(edit, dict) and "path" in edit for edit in body):
+            raise tornado.web.HTTPError(400, "Expected a list of {\"path\": ..., \"value\": ...} edits")
+
+        edits = []
+        for edit in body:
+            anchorKey, drilldownPath = self.resolveConfigPath(str(edit["path"]))
+            edits.append((edit["path"], anchorKey, drilldownPath, edit.get("value")))
+        changedCount = await self.applyConfigEdits(edits, strict=True)
+        self.writeResponse({"edits": len(edits), "changed": changedCount}, TYPE_JSON)
+
+    def resolveConfigPath(self, path):
+        """Map a config API path, such as zones/1/activities/home/htsp, to its index anchor and drilldown path."""
+        path = "/" + path.strip("/")
+        if not path.startswith("/config"):
+            path = "/config" + path
+        for pattern, xpathName in self.configRoutes:
+            match = pattern.match(path)
+            if match is not None:
+                pathVars = match.groupdict()
+                return ConfigIndex.getAnchorKey(xpathName, pathVars), pathVars.get("drilldownPath", "")
+        raise tornado.web.HTTPError(400, "Unrecognized config path: %s" % path)
+
+
+class ChangesHandler(BaseHandler):
+    """Report the changes waiting for the thermostat to pull them, and how long its last pulls took."""
+
+    async def get(self, **pathVars):
+        self.writeResponse((await self.getChangeTracker()).getSummary(), TYPE_JSON)
+
+
+class HistoryHandler(BaseHandler):
+    """Answer range queries over the recorded status history with downsampled aggregates."""
+
+    async def get(self, **pathVars):
+        """Accept from/to as epoch seconds or ISO 8601, a comma-separated fields list and a step in seconds."""
+        end = self.parseTime(self.get_query_argument("to", None), time.time())
+        start = self.parseTime(self.get_query_argument("from", None), max(end - 86400, MIN_TIMESTAMP))
+        if start >= end:
+            raise tornado.web.HTTPError(400, "'from' must be earlier than 'to'")
+        fields = [field for field in self.get_query_argument("fields", "").split(",") if field]
+        try:
+            step = int(self.get_query_argument("step", 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "'step' must be a number of seconds")
+
+        # Queries can scan days of segments, so run them away from both the IOLoop and the writer thread
+        history = self.getHistoryStore()
+        result = await tornado.ioloop.IOLoop.current().run_in_executor(None, history.query, start, end, fields, step)
+        self.writeResponse(result, TYPE_JSON)
+
+    @staticmethod
+    def parseTime(value, default):
+        if value is None or value == "":
+            return default
+        try:
+            timestamp = float(value)
+        except ValueError:
+            try:
+                parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Unrecognized time: %s" % value)
+            if parsed.tzinfo is None:
+                parsed = parsed.astimezone()
+            timestamp = parsed.timestamp()
+        # Also rejects nan and inf
+        if not MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP:
+            raise tornado.web.HTTPError(400, "Time out of range: %s" % value)
+        return timestamp
+
+
+class MetricsHandler(BaseHandler):
+    """Expose request, file I/O and XML processing metrics in Prometheus text format."""
+
+    requiresState = False
+
+    def get(self):
+        self.writeSerializedResponse(metrics.render(), TYPE_METRICS)
+
+
+def main(argv=None):
+    """Run the proxy as a service, configured from the command line."""
+    import argparse
+    parser = argparse.ArgumentParser(description="Local server and API for Carrier Infinity thermostats.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port for the thermostat protocol and API")
+    parser.add_argument("--state-dir", dest="stateDir", default=DEFAULT_STATEDIR, help="directory to keep system state in")
+    parser.add_argument("--log-level", dest="logLevel", default=DEFAULT_LOGLEVEL)
+    parser.add_argument("--system-id", dest="defaultSystemID", help="system used by API routes that do not name one")
+    parser.add_argument("--max-cached-systems", dest="maxCachedSystems", type=int, default=DEFAULT_MAXCACHEDSYSTEMS)
+    parser.add_argument("--wunderground-api-key", dest="wundergroundApiKey", default="")
+    parser.add_argument("--weather-base-url", dest="weatherBaseUrl", default=DEFAULT_WEATHERBASEURL)
+    parser.add_argument("--api-workers", dest="apiWorkers", type=int, default=0, help="read-only API worker processes to fork")
+    parser.add_argument("--api-port", dest="apiPort", type=int, default=DEFAULT_APIPORT, help="port of the API workers")
+    parser.add_argument("--max-upload-size", dest="maxUploadSize", type=int, default=DEFAULT_MAXUPLOADSIZE, help="largest accepted upload, in bytes")
+    parser.add_argument("--journal-size", dest="journalSize", type=int, default=DEFAULT_JOURNAL_SIZE,
+                        help="bytes of uploads and API edits to keep journaled per system, or 0 to disable the journal")
+    parser.add_argument("--no-journal-compression", dest="compressJournal", action="store_false", help="store journal records uncompressed")
+    InfinityProxy(**vars(parser.parse_args(argv)))
 
 
 if __name__ == "__main__":
-    InfinityProxy()
\ No newline at end of file
+    main()
\ No newline at end of file
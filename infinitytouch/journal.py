@@ -0,0 +1,333 @@
+import os
+import json
+import zlib
+import struct
+import shutil
+import logging
+import tempfile
+import collections
+import xml.etree.ElementTree as ET
+from .state import writeFileAtomic, formatOutgoingXml
+from .configindex import ConfigIndex
+from .metrics import metrics
+
+logger = logging.getLogger("InfinityProxy")
+
+# Payload length, CRC-32 of the payload, timestamp, record type, flags, name length.  The payload is the name and the body.
+RECORD_HEADER = struct.Struct("<IIdBBH")
+
+RECORD_UPLOAD = 1
+RECORD_NOTIFICATION = 2
+RECORD_EDITS = 3
+FLAG_COMPRESSED = 1
+
+DEFAULT_JOURNAL_SIZE = 64 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+COMPRESS_MIN_LENGTH = 256
+COMPRESS_LEVEL = 6
+MAX_RECORD_LENGTH = 0xFFFFFFFF
+COPY_CHUNK_SIZE = 64 * 1024
+TEMP_PREFIX = ".record."
+FILE_SYSTEM = "system.xml"
+
+JournalRecord = collections.namedtuple("JournalRecord", ("timestamp", "kind", "name", "body"))
+
+
+class RecordBuilder:
+    """One journal record whose body is streamed into a temp file as an upload arrives, so its size does not affect memory use.
+
+    Chunks are compressed as they are fed, and the length and checksum of the payload are kept as it grows,
+    so the record can be copied into a segment without reading it back first.  Methods that touch the temp
+    file are meant to be called on the writer thread.
+    """
+
+    def __init__(self, directory, kind, name, timestamp, compress=True):
+        self.directory = directory
+        self.kind = kind
+        self.name = name.encode()
+        self.timestamp = timestamp
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL) if compress else None
+        self.flags = FLAG_COMPRESSED if compress else 0
+        self.length = len(self.name)
+        self.checksum = zlib.crc32(self.name)
+        self.file = None
+        self.tempPath = None
+
+    def feed(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.writePayload(data)
+
+    def writePayload(self, data):
+        if not data:
+            return
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, self.tempPath = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=".tmp", dir=self.directory)
+            self.file = os.fdopen(fd, 'w+b')
+        self.file.write(data)
+        self.length += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def copyTo(self, target):
+        """Write the complete record to a segment file, returning the number of bytes written."""
+        if self.compressor is not None:
+            self.writePayload(self.compressor.flush())
+            self.compressor = None
+        if self.length > MAX_RECORD_LENGTH:
+            raise ValueError("Journal record for '{}' is too large".format(self.name.decode()))
+        target.write(RECORD_HEADER.pack(self.length, self.checksum, self.timestamp, self.kind, self.flags, len(self.name)))
+        target.write(self.name)
+        if self.file is not None:
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, target, COPY_CHUNK_SIZE)
+        return RECORD_HEADER.size + self.length
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.tempPath)
+            except OSError:
+                pass
+
+
+def encodeRecord(kind, name, body, timestamp, compress=True):
+    """Return a journal record with a complete body, as it is written to a segment."""
+    flags = 0
+    if compress:
+        body = zlib.compress(body, COMPRESS_LEVEL)
+        flags |= FLAG_COMPRESSED
+    name = name.encode()
+    payload = name + body
+    if len(payload) > MAX_RECORD_LENGTH:
+        raise ValueError("Journal record for '{}' is too large".format(name.decode()))
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload), timestamp, kind, flags, len(name)) + payload
+
+
+class Journal:
+    """Append-only log of the uploads and API edits received for one system, to rebuild its state files and to replay its traffic.
+
+    Records are appended to numbered segment files from the state writer thread, ordered before the state
+    writes they describe, and synced as they are written.  Each process starts a new segment, so a record
+    torn by a crash is always the last one in its segment.  Segments are rotated at segmentSize, and the
+    oldest are deleted once the journal is larger than maxSize.  The current segment stays open until it
+    is rotated or the journal is closed.
+    """
+
+    def __init__(self, directory, writer, maxSize=DEFAULT_JOURNAL_SIZE, segmentSize=DEFAULT_SEGMENT_SIZE, compress=True):
+        self.directory = directory
+        self.writer = writer
+        self.maxSize = maxSize
+        self.segmentSize = segmentSize
+        self.compress = compress
+        self.file = None
+        self.segmentNumber = None
+
+    def startRecord(self, kind, name, timestamp):
+        """Return a record whose body is fed in chunks on the writer thread as an upload arrives, to be appended with appendRecord()."""
+        return RecordBuilder(self.directory, kind, name, timestamp, self.compress)
+
+    def append(self, kind, name, body, timestamp):
+        """Append a record with a complete body, returning a future that resolves once it is written."""
+        return self.writer.run(self.writeData, kind, name, body, timestamp)
+
+    def appendRecord(self, record):
+        return self.writer.run(self.writeRecord, record)
+
+    def discardRecord(self, record):
+        return self.writer.run(record.discard)
+
+    def close(self):
+        """Close the current segment on the writer thread, returning a future.  A later record starts a new segment."""
+        future = self.writer.run(self.closeSegment)
+        future.add_done_callback(self.logCloseFailure)
+        return future
+
+    def logCloseFailure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Failed to close the journal in '%s': %s", self.directory, future.exception())
+
+    def writeData(self, kind, name, body, timestamp):
+        data = encodeRecord(kind, name, body, timestamp, self.compress and len(body) >= COMPRESS_MIN_LENGTH)
+        self.getSegment().write(data)
+        self.finishWrite(len(data))
+
+    def writeRecord(self, record):
+        try:
+            length = record.copyTo(self.getSegment())
+        finally:
+            record.discard()
+        self.finishWrite(length)
+
+    def getSegment(self):
+        if self.file is None:
+            self.openSegment()
+        return self.file
+
+    def finishWrite(self, length):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        metrics.increment("infinity_journal_bytes_total", amount=length)
+        if self.file.tell() >= self.segmentSize:
+            self.closeSegment()
+
+    def openSegment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.segmentNumber is None:
+            segments = getSegmentNumbers(self.directory)
+            self.segmentNumber = segments[-1] if segments else 0
+            self.removeTempFiles()
+        self.segmentNumber += 1
+        self.file = open(getSegmentPath(self.directory, self.segmentNumber), 'ab')
+        self.prune()
+
+    def removeTempFiles(self):
+        """Delete the bodies of records that were still streaming when the previous process stopped."""
+        for fileName in os.listdir(self.directory):
+            if fileName.startswith(TEMP_PREFIX):
+                try:
+                    os.remove(os.path.join(self.directory, fileName))
+                except OSError:
+                    pass
+
+    def closeSegment(self):
+        """Close the current segment, so the next record starts a new one."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def prune(self):
+        """Delete the oldest segments while the journal is larger than maxSize, always keeping the current one."""
+        segments = [(number, os.path.getsize(getSegmentPath(self.directory, number))) for number in getSegmentNumbers(self.directory)]
+        total = sum(size for number, size in segments)
+        for number, size in segments:
+            if total <= self.maxSize or number == self.segmentNumber:
+                break
+            os.remove(getSegmentPath(self.directory, number))
+            total -= size
+            logger.debug("Removed journal segment %d of '%s'", number, self.directory)
+
+
+def getSegmentPath(directory, number):
+    return os.path.join(directory, "journal-{:08d}.log".format(number))
+
+
+def getSegmentNumbers(directory):
+    try:
+        fileNames = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(fileName[8:-4]) for fileName in fileNames
+                  if fileName.startswith("journal-") and fileName.endswith(".log") and fileName[8:-4].isdigit())
+
+
+def readJournal(directory):
+    """Yield the records of a journal in the order they were written.
+
+    Reading a segment stops at the first incomplete or corrupted record, which can only be the last one
+    written before a crash, and continues with the next segment.
+    """
+    for number in getSegmentNumbers(directory):
+        segmentPath = getSegmentPath(directory, number)
+        try:
+            f = open(segmentPath, 'rb')
+        except FileNotFoundError:
+            continue
+        with f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                if len(header) < RECORD_HEADER.size:
+                    logger.warning("Ignoring a truncated record at the end of '%s'", segmentPath)
+                    break
+                length, checksum, timestamp, kind, flags, nameLength = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum or nameLength > length:
+                    logger.warning("Ignoring a corrupted record and the rest of '%s'", segmentPath)
+                    break
+                body = payload[nameLength:]
+                if flags & FLAG_COMPRESSED:
+                    body = zlib.decompress(body)
+                yield JournalRecord(timestamp, kind, payload[:nameLength].decode(), body)
+
+
+def encodeEdits(edits):
+    """Encode (anchorKey, drilldownPath, value) config edits as the body of an edits record."""
+    return json.dumps([[list(anchorKey), drilldownPath, value] for anchorKey, drilldownPath, value in edits]).encode()
+
+
+def decodeEdits(body):
+    return [(tuple(anchorKey), drilldownPath, value) for anchorKey, drilldownPath, value in json.loads(body)]
+
+
+def recoverState(stateDirectory, journalDirectory):
+    """Rebuild the state files of one system from its journal, returning the names of the files rewritten.
+
+    A file is only rewritten if it is missing, cannot be parsed, or is older than the last record for it,
+    which means the proxy stopped between journaling a change and saving it.  API edits are applied on top
+    of the last upload of system.xml in the journal, or of the file on disk once that upload has been pruned.
+    Recovery runs once at startup, before any request is served, so it uses plain blocking I/O.
+    """
+    uploads = {}
+    edits = []
+    lastTimes = {}
+    for record in readJournal(journalDirectory):
+        if record.kind == RECORD_UPLOAD:
+            uploads[record.name] = record.body
+            if record.name == FILE_SYSTEM:
+                edits = []
+        elif record.kind == RECORD_EDITS:
+            edits.extend(decodeEdits(record.body))
+        else:
+            continue
+        lastTimes[record.name if record.kind == RECORD_UPLOAD else FILE_SYSTEM] = record.timestamp
+
+    recovered = []
+    for fileName, lastTime in lastTimes.items():
+        filePath = os.path.join(stateDirectory, fileName)
+        current = readIntactFile(filePath)
+        if current is not None and os.path.getmtime(filePath) >= lastTime:
+            continue
+        data = uploads.get(fileName, current)
+        if data is None:
+            logger.error("Cannot recover '%s', since the journal no longer holds a complete copy of it", filePath)
+            continue
+        if fileName == FILE_SYSTEM and edits:
+            try:
+                data = applyEdits(data, edits)
+            except ET.ParseError as e:
+                logger.error("Cannot apply the journaled edits to '%s': %s", filePath, e)
+                continue
+        if data != current:
+            writeFileAtomic(filePath, data)
+            recovered.append(fileName)
+            logger.warning("Recovered '%s' from the journal", filePath)
+    return recovered
+
+
+def readIntactFile(filePath):
+    """Return the contents of a state file, or None if it is missing or is not well-formed XML."""
+    try:
+        with open(filePath, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        ET.fromstring(data)
+    except ET.ParseError as e:
+        logger.error("State file '%s' is corrupted: %s", filePath, e)
+        return None
+    return data
+
+
+def applyEdits(data, edits):
+    root = ET.fromstring(data)
+    configIndex = ConfigIndex(root)
+    for anchorKey, drilldownPath, value in edits:
+        element = configIndex.find(anchorKey, drilldownPath)
+        if element is not None:
+            element.text = value
+    return formatOutgoingXml(root)
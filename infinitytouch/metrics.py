@@ -0,0 +1,117 @@
+import time
+import bisect
+import threading
+import contextlib
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152)
+
+
+class Histogram:
+    """Bucketed observation counts, with the total and sum needed for Prometheus histograms."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Counters and histograms keyed by metric name and label values, exposed in Prometheus text format.
+
+    Observations are cheap dict and list updates.  State files are written from a worker thread,
+    so updates take a lock that is uncontended in practice.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.types = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def describe(self, name, metricType, helpText):
+        self.types[name] = metricType
+        self.help[name] = helpText
+
+    def increment(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=()):
+        """Observe the duration of a block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (histogram.buckets, list(histogram.counts), histogram.count, histogram.sum))
+                                for key, histogram in self.histograms.items())
+        lastName = None
+        for (name, labels), value in counters:
+            if name != lastName:
+                lines.extend(self.renderHeader(name, "counter"))
+                lastName = name
+            lines.append("{}{} {}".format(name, self.formatLabels(labels), value))
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            if name != lastName:
+                lines.extend(self.renderHeader(name, "histogram"))
+                lastName = name
+            cumulative = 0
+            for bound, bucketCount in zip(buckets, counts):
+                cumulative += bucketCount
+                lines.append("{}_bucket{} {}".format(name, self.formatLabels(labels + (("le", repr(float(bound))),)), cumulative))
+            lines.append("{}_bucket{} {}".format(name, self.formatLabels(labels + (("le", "+Inf"),)), count))
+            lines.append("{}_sum{} {}".format(name, self.formatLabels(labels), repr(total)))
+            lines.append("{}_count{} {}".format(name, self.formatLabels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def renderHeader(self, name, defaultType):
+        header = []
+        if name in self.help:
+            header.append("# HELP {} {}".format(name, self.help[name]))
+        header.append("# TYPE {} {}".format(name, self.types.get(name, defaultType)))
+        return header
+
+    @staticmethod
+    def formatLabels(labels):
+        if not labels:
+            return ""
+        escaped = ('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for key, value in labels)
+        return "{" + ",".join(escaped) + "}"
+
+
+metrics = Metrics()
+metrics.describe("infinity_http_requests_total", "counter", "Requests handled, by route and response status.")
+metrics.describe("infinity_http_request_duration_seconds", "histogram", "Time taken to handle a request.")
+metrics.describe("infinity_http_request_size_bytes", "histogram", "Size of request bodies.")
+metrics.describe("infinity_http_response_size_bytes", "histogram", "Size of response bodies.")
+metrics.describe("infinity_file_io_seconds", "histogram", "Time taken to read or atomically write a state file.")
+metrics.describe("infinity_xml_parse_seconds", "histogram", "Time taken to parse a state file.")
+metrics.describe("infinity_xml_serialize_seconds", "histogram", "Time taken to serialize a state file tree to XML.")
+metrics.describe("infinity_json_serialize_seconds", "histogram", "Time taken to project a state file tree to JSON.")
+metrics.describe("infinity_startup_seconds", "histogram", "Time taken to warm the state at startup, and from process start until listening.")
+metrics.describe("infinity_change_pull_seconds", "histogram", "Time from queuing a change for the thermostat until it pulled it.")
+metrics.describe("infinity_journal_bytes_total", "counter", "Bytes appended to the journals of uploads and API edits.")
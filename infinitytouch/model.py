@@ -0,0 +1,351 @@
+import re
+import xml.etree.ElementTree as ET
+from .state import formatOutgoingXml, elementToDict
+
+
+class Field:
+    """Typed access to the text of a child element.
+
+    Values are converted on every access rather than copied out of the tree, so a model costs
+    no more memory than the parsed file it wraps.
+    """
+
+    __slots__ = ("path",)
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def __set_name__(self, owner, name):
+        if self.path is None:
+            self.path = name
+
+    def __get__(self, node, owner=None):
+        if node is None:
+            return self
+        element = node.element.find(self.path)
+        if element is None or not element.text:
+            return None
+        try:
+            return self.fromText(element.text.strip())
+        except ValueError:
+            return None
+
+    def __set__(self, node, value):
+        element = node.element.find(self.path)
+        if element is None:
+            raise AttributeError("{} has no {} element".format(type(node).__name__, self.path))
+        text = "" if value is None else self.toText(value)
+        if (element.text or "") != text:
+            element.text = text
+            node.markChanged()
+
+    def fromText(self, text):
+        return text
+
+    def toText(self, value):
+        return str(value)
+
+
+class FloatField(Field):
+    __slots__ = ()
+
+    def fromText(self, text):
+        return float(text)
+
+    def toText(self, value):
+        return str(float(value))
+
+
+class IntField(Field):
+    __slots__ = ()
+
+    def fromText(self, text):
+        return int(text)
+
+    def toText(self, value):
+        return str(int(value))
+
+
+class SwitchField(Field):
+    """An on/off element, as a bool."""
+
+    __slots__ = ()
+
+    def fromText(self, text):
+        if text not in ("on", "off"):
+            raise ValueError(text)
+        return text == "on"
+
+    def toText(self, value):
+        return "on" if value else "off"
+
+
+class Child:
+    """A single child element, wrapped in a model class when first accessed."""
+
+    __slots__ = ("path", "nodeType", "name")
+
+    def __init__(self, path, nodeType):
+        self.path = path
+        self.nodeType = nodeType
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, node, owner=None):
+        if node is None:
+            return self
+        return node.getChild(self.name, lambda: self.materialize(node))
+
+    def materialize(self, node):
+        element = node.element.find(self.path)
+        return None if element is None else self.nodeType(element, node)
+
+
+class Children(Child):
+    """Repeated child elements, wrapped in model classes keyed by their id attribute when first accessed."""
+
+    __slots__ = ()
+
+    def materialize(self, node):
+        return {element.get("id"): self.nodeType(element, node) for element in node.element.iterfind(self.path)}
+
+
+class Node:
+    """Model of one element of a parsed state file.
+
+    Nodes are views over the cached tree, so reading a field never copies the tree and setting one
+    edits it in place.  Child nodes are only created when they are first accessed.
+    """
+
+    __slots__ = ("element", "parent", "children")
+
+    def __init__(self, element, parent=None):
+        self.element = element
+        self.parent = parent
+        self.children = None
+
+    @property
+    def id(self):
+        return self.element.get("id")
+
+    def getChild(self, name, materialize):
+        if self.children is None:
+            self.children = {}
+        if name not in self.children:
+            self.children[name] = materialize()
+        return self.children[name]
+
+    def markChanged(self, zoneID=None):
+        if self.parent is not None:
+            self.parent.markChanged(zoneID)
+
+    def toDict(self):
+        """Return the same projection of the element as the JSON API."""
+        return elementToDict(self.element)
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, self.id) if self.id is not None else "<{}>".format(type(self).__name__)
+
+
+class Activity(Node):
+    __slots__ = ()
+
+    htsp = FloatField()
+    clsp = FloatField()
+    fan = Field()
+
+
+class Period(Node):
+    __slots__ = ()
+
+    activity = Field()
+    time = Field()
+    enabled = SwitchField()
+
+
+class ProgramDay(Node):
+    __slots__ = ()
+
+    periods = Children("period", Period)
+
+
+class Zone(Node):
+    __slots__ = ()
+
+    name = Field()
+    enabled = SwitchField()
+    hold = SwitchField()
+    holdActivity = Field()
+    otmr = Field()
+    occEnabled = SwitchField()
+    activities = Children("activities/activity", Activity)
+    program = Children("program/day", ProgramDay)
+
+    def markChanged(self, zoneID=None):
+        Node.markChanged(self, self.id)
+
+
+class System(Node):
+    """Model of system.xml.
+
+    The serialized form of every zone is kept, so re-serializing after an edit only serializes
+    the zones that changed and the small remainder of the file outside of the zones.
+    """
+
+    __slots__ = ("shellParts", "zoneParts", "dirtyZones", "sectioned")
+
+    slotPattern = re.compile(b"<!--\\[\\[slot:(\\d+)\\]\\]-->")
+
+    mode = Field("config/mode")
+    cfgem = Field("config/cfgem")
+    cfgtype = Field("config/cfgtype")
+    vacat = SwitchField("config/vacat")
+    vacmint = FloatField("config/vacmint")
+    vacmaxt = FloatField("config/vacmaxt")
+    vacfan = Field("config/vacfan")
+    filtertype = Field("config/filtertype")
+    filterinterval = IntField("config/filterinterval")
+    zones = Children("config/zones/zone", Zone)
+    wholeHouseActivities = Children("config/wholeHouse/activities/activity", Activity)
+
+    def __init__(self, element, parent=None):
+        Node.__init__(self, element, parent)
+        self.shellParts = None
+        self.zoneParts = {}
+        self.dirtyZones = set()
+        zoneIDs = [zone.get("id") for zone in element.iterfind("config/zones/zone")]
+        # Zones are serialized on their own, which is only equivalent without namespaces and with unique IDs
+        self.sectioned = (None not in zoneIDs and len(set(zoneIDs)) == len(zoneIDs)
+                          and not any(child.tag.startswith("{") for child in element.iter() if isinstance(child.tag, str)))
+
+    def markChanged(self, zoneID=None):
+        if zoneID is None:
+            self.shellParts = None
+        else:
+            self.dirtyZones.add(zoneID)
+
+    def invalidate(self):
+        """Forget every serialized section, after edits made to the tree outside of the model."""
+        self.shellParts = None
+        self.zoneParts.clear()
+
+    def serialize(self):
+        """Return the compact XML of the whole file, reusing the bytes of every unchanged zone."""
+        if not self.sectioned:
+            return formatOutgoingXml(self.element)
+        zonesElement = self.element.find("config/zones")
+        if zonesElement is None:
+            return formatOutgoingXml(self.element)
+        zones = [zone for zone in zonesElement if zone.tag == "zone"]
+        if self.shellParts is None:
+            self.shellParts = self.serializeShell(zonesElement)
+        parts = [self.shellParts[0]]
+        for zone, chunk in zip(zones, self.shellParts[1:]):
+            zoneID = zone.get("id")
+            if zoneID in self.dirtyZones or zoneID not in self.zoneParts:
+                self.zoneParts[zoneID] = self.serializeZone(zone)
+            parts.append(self.zoneParts[zoneID])
+            parts.append(chunk)
+        self.dirtyZones.clear()
+        return b"".join(parts)
+
+    def serializeShell(self, zonesElement):
+        """Serialize everything outside of the zones, returning the static chunks between them."""
+        children = list(zonesElement)
+        slot = 0
+        for position, child in enumerate(children):
+            if child.tag == "zone":
+                placeholder = ET.Comment("[[slot:{}]]".format(slot))
+                placeholder.tail = child.tail
+                zonesElement[position] = placeholder
+                slot += 1
+        try:
+            xmlString = formatOutgoingXml(self.element)
+        finally:
+            zonesElement[:] = children
+        return self.slotPattern.split(xmlString)[::2]
+
+    @staticmethod
+    def serializeZone(zone):
+        tail, zone.tail = zone.tail, None
+        try:
+            return formatOutgoingXml(zone)
+        finally:
+            zone.tail = tail
+
+
+class EquipmentStatus(Node):
+    __slots__ = ()
+
+    type = Field()
+    opstat = Field()
+    cfm = IntField()
+    statpress = FloatField()
+    blwrpm = IntField()
+
+
+class ZoneStatus(Node):
+    __slots__ = ()
+
+    name = Field()
+    enabled = SwitchField()
+    currentActivity = Field()
+    rt = FloatField()
+    rh = IntField()
+    fan = Field()
+    hold = SwitchField()
+    htsp = FloatField()
+    clsp = FloatField()
+    damperposition = IntField()
+    occupancy = Field()
+
+
+class Status(Node):
+    """Model of status.xml."""
+
+    __slots__ = ()
+
+    localTime = Field()
+    oat = FloatField()
+    mode = Field()
+    cfgem = Field()
+    vacatrunning = SwitchField()
+    filtrlvl = IntField()
+    humlvl = IntField()
+    ventlvl = IntField()
+    humid = Field()
+    unocc = SwitchField()
+    idu = Child("idu", EquipmentStatus)
+    odu = Child("odu", EquipmentStatus)
+    zones = Children("zones/zone", ZoneStatus)
+
+
+class Change:
+    __slots__ = ("attributes", "text")
+
+    def __init__(self, attributes, text):
+        self.attributes = attributes
+        self.text = text
+
+    def toDict(self):
+        return {"attributes": self.attributes, "text": self.text}
+
+
+class Notification:
+    """A notification sent by the thermostat after it has applied an update."""
+
+    __slots__ = ("type", "code", "message", "timestamp", "changes")
+
+    fields = ("type", "code", "message", "timestamp")
+
+    def __init__(self, type=None, code=None, message=None, timestamp=None, changes=None):
+        self.type = type
+        self.code = code
+        self.message = message
+        self.timestamp = timestamp
+        self.changes = changes if changes is not None else []
+
+    def toDict(self):
+        return {"type": self.type, "code": self.code, "message": self.message, "timestamp": self.timestamp,
+                "changes": [change.toDict() for change in self.changes]}
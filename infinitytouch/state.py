@@ -0,0 +1,607 @@
+import os
+import re
+import mmap
+import struct
+import asyncio
+import logging
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tornado.ioloop
+from tornado.concurrent import Future
+from .metrics import metrics
+
+logger = logging.getLogger("InfinityProxy")
+
+MAX_DERIVED_VALUES = 1024
+FILE_GENERATIONS = ".generations"
+
+# Temp files are created private, so apply the permissions a plain open() would have used
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+
+def formatOutgoingXml(rootElement):
+    """Serialize an element to the compact form expected by the thermostat."""
+    xmlString = ET.tostring(rootElement)
+    xmlString = xmlString.replace(b" />", b"/>")  # Remove the extra space that ElementTree inserts in tag name of empty elements
+    xmlString = re.sub(b"(\\s\\s+)|\\n", b"", xmlString)  # Strip space/tab formatting
+    return xmlString
+
+
+textFormatting = re.compile("(\\s\\s+)|\\n", re.ASCII)
+attributeFormatting = re.compile("  +")
+
+
+def elementToDict(element):
+    """Convert an element to the same structure that xmltodict.parse() returns for its formatOutgoingXml() output.
+
+    Whitespace is dropped the same way formatOutgoingXml() drops it, so the two paths produce identical JSON.
+    Namespaced trees are converted through xmltodict, since it keeps the original prefixes.
+    """
+    if any(child.tag[:1] == "{" for child in element.iter()) or any(key[:1] == "{" for child in element.iter() for key in child.attrib):
+        import xmltodict
+        return xmltodict.parse(formatOutgoingXml(element))
+    return {element.tag: elementValue(element)}
+
+
+def elementValue(element):
+    value = None
+    if element.attrib:
+        value = {"@" + key: attributeFormatting.sub("", attrValue) for key, attrValue in element.attrib.items()}
+    texts = [element.text] if element.text else []
+    for child in element:
+        if value is None:
+            value = {}
+        childValue = elementValue(child)
+        if child.tag in value:
+            existing = value[child.tag]
+            if isinstance(existing, list):
+                existing.append(childValue)
+            else:
+                value[child.tag] = [existing, childValue]
+        else:
+            value[child.tag] = childValue
+        if child.tail:
+            texts.append(child.tail)
+    text = "".join(textFormatting.sub("", text) for text in texts).strip() if texts else ""
+    if not text:
+        return value
+    if value is None:
+        return text
+    value["#text"] = text
+    return value
+
+
+def readFile(filePath):
+    """Return the contents and modification time of a file."""
+    with metrics.timer("infinity_file_io_seconds", (("operation", "read"),)):
+        with open(filePath, 'rb') as f:
+            data = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime
+    return data, mtime
+
+
+def writeFileAtomic(filePath, data):
+    """Replace a file via a synced temp file and rename, so readers never see a partial write.
+
+    A data value of None removes the file instead, and a StagedFile is renamed into place.
+    Returns the new modification time.
+    """
+    if isinstance(data, StagedFile):
+        return data.commit(filePath)
+    if data is None:
+        try:
+            os.remove(filePath)
+        except FileNotFoundError:
+            pass
+        return None
+    directory, fileName = os.path.split(filePath)
+    fd, tempPath = tempfile.mkstemp(prefix=".{}.".format(fileName), suffix=".tmp", dir=directory or ".")
+    try:
+        os.fchmod(fd, 0o666 & ~FILE_UMASK)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, filePath)
+    except BaseException:
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        raise
+    return os.path.getmtime(filePath)
+
+
+class StagedFile:
+    """New contents for a state file, streamed into a temp file next to it and renamed into place when complete.
+
+    The file is only touched from the writer thread, so its methods are meant to be called through StateWriter.run().
+    """
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.tempPath = None
+        self.file = None
+        self.size = 0
+
+    def open(self):
+        if self.file is None:
+            directory, fileName = os.path.split(self.filePath)
+            fd, self.tempPath = tempfile.mkstemp(prefix=".{}.".format(fileName), suffix=".tmp", dir=directory or ".")
+            os.fchmod(fd, 0o666 & ~FILE_UMASK)
+            self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.open()
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self, filePath):
+        self.open()
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.replace(self.tempPath, filePath)
+        except BaseException:
+            self.discard()
+            raise
+        return os.path.getmtime(filePath)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.tempPath)
+            except OSError:
+                pass
+
+
+class StateWriter:
+    """Persist files from a worker thread, coalescing writes so only the latest pending data for a file hits disk."""
+
+    def __init__(self, executor=None):
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1, thread_name_prefix="StateWriter")
+        self.pending = {}
+        self.flushing = set()
+
+    def write(self, filePath, data):
+        """Queue data for a file, returning a future that resolves with the file's mtime once it is on disk.
+
+        If a write to the same file is already queued, its data is replaced and both callers wait on the newer write.
+        """
+        future = Future()
+        if filePath in self.pending:
+            replacedData, waiters = self.pending[filePath]
+            if isinstance(replacedData, StagedFile):
+                self.run(replacedData.discard)
+            waiters.append(future)
+            self.pending[filePath] = (data, waiters)
+        else:
+            self.pending[filePath] = (data, [future])
+        if filePath not in self.flushing:
+            self.flushing.add(filePath)
+            tornado.ioloop.IOLoop.current().spawn_callback(self.flush, filePath)
+        return future
+
+    @staticmethod
+    def timedWrite(filePath, data):
+        with metrics.timer("infinity_file_io_seconds", (("operation", "write"),)):
+            return writeFileAtomic(filePath, data)
+
+    async def flush(self, filePath):
+        try:
+            while filePath in self.pending:
+                data, waiters = self.pending.pop(filePath)
+                try:
+                    mtime = await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, self.timedWrite, filePath, data)
+                except Exception as e:
+                    logger.error("Failed to write '%s': %s'", filePath, e)
+                    for waiter in waiters:
+                        waiter.set_exception(e)
+                else:
+                    for waiter in waiters:
+                        waiter.set_result(mtime)
+        finally:
+            self.flushing.discard(filePath)
+
+    async def read(self, filePath):
+        return await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, readFile, filePath)
+
+    def run(self, func, *args):
+        """Run other file I/O on the writer thread, ordered with the queued state writes."""
+        return tornado.ioloop.IOLoop.current().run_in_executor(self.executor, func, *args)
+
+
+class SharedGenerations:
+    """Publish the generations of a system's state files, in a small memory-mapped file shared between processes.
+
+    The writing process publishes a file's generation once a write of it has been renamed into place, and
+    reading processes compare it against the generation they last loaded, without a syscall per request.
+    The file outlives the processes, so a restarted writer continues from the published generations.
+    It is mapped on first use, and unmapped by close() while the system is idle.
+    """
+
+    slot = struct.Struct("<Q")
+
+    def __init__(self, filePath, fileNames):
+        self.filePath = filePath
+        self.slots = {fileName: index * self.slot.size for index, fileName in enumerate(fileNames)}
+        self.size = self.slot.size * len(fileNames)
+        self.map = None
+        self.getMap()
+
+    def getMap(self):
+        if self.map is None:
+            fd = os.open(self.filePath, os.O_RDWR | os.O_CREAT, 0o666 & ~FILE_UMASK)
+            try:
+                if os.fstat(fd).st_size < self.size:
+                    os.ftruncate(fd, self.size)
+                self.map = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+        return self.map
+
+    def get(self, fileName):
+        offset = self.slots.get(fileName)
+        if offset is None:
+            return None
+        return self.slot.unpack_from(self.getMap(), offset)[0]
+
+    def publish(self, fileName, generation):
+        offset = self.slots.get(fileName)
+        if offset is not None and generation > self.slot.unpack_from(self.getMap(), offset)[0]:
+            self.slot.pack_into(self.map, offset, generation)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class StateEntry:
+    """Cached contents of a single state file."""
+
+    def __init__(self, data=None, root=None, mtime=None):
+        self.data = data
+        self.root = root
+        self.serialized = None
+        self.mtime = mtime
+        self.derived = {}
+
+
+class StateStore:
+    """Per-process cache of the parsed state files, with write-through persistence to the state directory.
+
+    Reads are served from memory once a file has been loaded.  Every write made through the store
+    bumps the generation of the file, so anything derived from an older tree can be detected as stale.
+    """
+
+    def __init__(self, stateDirectory, writer=None, systemID=None, onAccess=None, sharedGenerations=None, readOnly=False, epoch=None):
+        self.stateDirectory = stateDirectory
+        self.epoch = epoch if epoch is not None else os.urandom(4).hex()
+        self.writer = writer if writer is not None else StateWriter()
+        self.systemID = systemID
+        self.onAccess = onAccess
+        self.sharedGenerations = sharedGenerations
+        self.readOnly = readOnly
+        self.entries = {}
+        self.generations = {}
+        self.loadedSharedGenerations = {}
+        self.inflightWrites = 0
+        self.pendingWrites = {}
+        self.history = None
+        self.changes = None
+        self.journal = None
+        if sharedGenerations is not None and not readOnly:
+            # Entity tags are built from the generations in every process, so they must not start again from zero
+            self.generations = {fileName: sharedGenerations.get(fileName) for fileName in sharedGenerations.slots}
+
+    def getPath(self, fileName):
+        return os.path.join(self.stateDirectory, fileName)
+
+    def markAccessed(self):
+        if self.onAccess is not None:
+            self.onAccess(self)
+
+    async def getEntry(self, fileName):
+        self.markAccessed()
+        if self.readOnly and self.sharedGenerations is not None:
+            self.followSharedGeneration(fileName)
+        entry = self.entries.get(fileName)
+        if entry is None:
+            entry = await self.loadEntry(fileName)
+        return entry
+
+    async def loadEntry(self, fileName):
+        # A staged upload is not cached, so it is only visible on disk once its write completes
+        pending = self.pendingWrites.get(fileName)
+        while pending is not None and not pending.done():
+            try:
+                await pending
+            except Exception:
+                pass
+            if fileName in self.entries:
+                return self.entries[fileName]
+            pending = self.pendingWrites.get(fileName)
+        filePath = self.getPath(fileName)
+        generation = self.getGeneration(fileName)
+        try:
+            data, mtime = await self.writer.read(filePath)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error("Failed to read '%s': %s'", filePath, e)
+            return None
+        if fileName in self.entries or generation != self.getGeneration(fileName):
+            # The file was written while it was being read, so the in-memory copy is newer
+            return self.entries.get(fileName)
+        entry = StateEntry(data=data, mtime=mtime)
+        self.entries[fileName] = entry
+        return entry
+
+    def followSharedGeneration(self, fileName):
+        """Drop a cached file once the writing process has published a newer version of it."""
+        published = self.sharedGenerations.get(fileName)
+        if published is not None and published != self.loadedSharedGenerations.get(fileName):
+            self.invalidate(fileName)
+            self.loadedSharedGenerations[fileName] = published
+
+    def getGeneration(self, fileName):
+        return self.generations.get(fileName, 0)
+
+    def getETag(self, fileName):
+        """Return an entity tag for the current version of a state file, without reading or serializing it.
+
+        The epoch changes on every restart, since generations of files that are not shared start again from zero.
+        Reading processes use the generation published by the writer, so both hand out the same tag for a version.
+        """
+        if self.readOnly and self.sharedGenerations is not None:
+            generation = self.loadedSharedGenerations.get(fileName, 0)
+        else:
+            generation = self.getGeneration(fileName)
+        return 'W/"{}-{:x}"'.format(self.epoch, generation)
+
+    def bumpGeneration(self, fileName):
+        self.generations[fileName] = self.generations.get(fileName, 0) + 1
+
+    async def getRoot(self, fileName):
+        """Return the cached root element of a state file, parsing it on first use.
+
+        The returned tree is shared, so callers must not modify it unless they hand it back with updateRoot().
+        """
+        entry = await self.getEntry(fileName)
+        if entry is None:
+            return None
+        if entry.root is None:
+            with metrics.timer("infinity_xml_parse_seconds", (("file", fileName),)):
+                entry.root = ET.fromstring(entry.data)
+        return entry.root
+
+    async def getSerialized(self, fileName):
+        """Return the compact serialized form of a state file's tree."""
+        entry = await self.getEntry(fileName)
+        if entry is None:
+            return None
+        if entry.serialized is None:
+            root = await self.getRoot(fileName)
+            with metrics.timer("infinity_xml_serialize_seconds", (("file", fileName),)):
+                entry.serialized = formatOutgoingXml(root)
+        return entry.serialized
+
+    async def getDerived(self, fileName, key, factory):
+        """Return a value computed from a state file's root element, memoized until the file next changes."""
+        entry = await self.getEntry(fileName)
+        if entry is None:
+            return None
+        if key in entry.derived:
+            return entry.derived[key]
+        value = factory(await self.getRoot(fileName))
+        if len(entry.derived) < MAX_DERIVED_VALUES:
+            entry.derived[key] = value
+        return value
+
+    def stageFile(self, fileName):
+        """Start streaming new contents for a state file into a temp file, to be passed to write() once complete."""
+        return StagedFile(self.getPath(fileName))
+
+    async def write(self, fileName, data):
+        """Replace the contents of a state file, in memory and on disk.
+
+        Staged files are never cached, and are loaded from disk when next read.
+        """
+        self.bumpGeneration(fileName)
+        entry = None
+        if not isinstance(data, StagedFile):
+            self.markAccessed()
+            entry = StateEntry(data=data)
+            self.entries[fileName] = entry
+        else:
+            self.entries.pop(fileName, None)
+        await self.persist(fileName, data, entry)
+
+    async def updateRoot(self, fileName, root, keepDerived=(), serialized=None):
+        """Store a modified tree for a state file and write its serialized form to disk.
+
+        Derived values named in keepDerived survive the update, for values that only depend on the tree's structure.
+        Callers that can serialize the tree more cheaply than formatOutgoingXml() may pass the result in serialized.
+        """
+        self.bumpGeneration(fileName)
+        self.markAccessed()
+        oldEntry = self.entries.get(fileName)
+        entry = StateEntry(root=root)
+        if oldEntry is not None and oldEntry.root is root:
+            entry.derived = {key: oldEntry.derived[key] for key in keepDerived if key in oldEntry.derived}
+        if serialized is None:
+            with metrics.timer("infinity_xml_serialize_seconds", (("file", fileName),)):
+                serialized = formatOutgoingXml(root)
+        entry.serialized = entry.data = serialized
+        self.entries[fileName] = entry
+        await self.persist(fileName, entry.serialized, entry)
+
+    def invalidate(self, fileName):
+        """Drop the cached copy of a file, forcing the next read to load it from disk."""
+        entry = self.entries.pop(fileName, None)
+        if entry is not None:
+            self.bumpGeneration(fileName)
+            if self.sharedGenerations is not None and not self.readOnly:
+                self.sharedGenerations.publish(fileName, self.getGeneration(fileName))
+            logger.debug("Invalidated cached state for '%s'", fileName)
+
+    def clearCache(self):
+        """Drop every cached file without changing generations, since the files on disk are unchanged.
+
+        The history, change tracker and journal are released as well, to be created again when next used, and
+        the shared generations are unmapped.  Returns the future of closing the journal's open segment, or None.
+        """
+        self.entries.clear()
+        self.history = None
+        if self.changes is not None and self.changes.filePath not in self.writer.flushing:
+            # Dropped once its last save is on disk, since a new tracker loads the file again
+            self.changes = None
+        if self.sharedGenerations is not None:
+            self.sharedGenerations.close()
+        closing = None
+        if self.journal is not None:
+            closing = self.journal.close()
+            self.journal = None
+        return closing
+
+    async def persist(self, fileName, data, entry=None):
+        if self.readOnly:
+            raise PermissionError("State for system '{}' is read-only in this process".format(self.systemID))
+        generation = self.getGeneration(fileName)
+        self.inflightWrites += 1
+        pending = self.pendingWrites[fileName] = self.writer.write(self.getPath(fileName), data)
+        try:
+            mtime = await pending
+        finally:
+            self.inflightWrites -= 1
+            if self.pendingWrites.get(fileName) is pending:
+                del self.pendingWrites[fileName]
+        if self.sharedGenerations is not None:
+            self.sharedGenerations.publish(fileName, generation)
+        if entry is not None and self.entries.get(fileName) is entry:
+            entry.mtime = mtime
+
+
+class StateRegistry:
+    """Per-system state stores, each kept in its own subdirectory of the state directory.
+
+    Stores are looked up by systemID in a dict.  Only the most recently used maxCachedSystems stores
+    keep their parsed files in memory and their files open; older ones are reloaded from disk when next
+    accessed.  The stores themselves are kept, since their generations keep entity tags unique and requests
+    in progress may still hold them.  The files named
+    in legacyFiles, which earlier versions kept in the root of the state directory, are moved into the
+    directory of the default system when its store is created.
+    """
+
+    def __init__(self, stateDirectory, defaultSystemID=None, maxCachedSystems=16, writer=None, sharedFiles=(), readOnly=False, epoch=None,
+                 legacyFiles=()):
+        self.stateDirectory = stateDirectory
+        self.legacyFiles = tuple(legacyFiles)
+        self.epoch = epoch if epoch is not None else os.urandom(4).hex()
+        self.sharedFiles = tuple(sharedFiles)
+        self.readOnly = readOnly
+        self.defaultSystemID = defaultSystemID or None
+        self.maxCachedSystems = max(1, int(maxCachedSystems))
+        self.writer = writer if writer is not None else StateWriter()
+        self.stores = {}
+        self.cachedStores = OrderedDict()
+        self.discoveredMtime = None
+
+    def discover(self):
+        """Register the systems already present in the state directory.
+
+        Runs at startup, and again in read-only processes until a system exists, whenever the directory has changed.
+        """
+        self.discoveredMtime = self.getDirectoryMtime()
+        try:
+            systemIDs = sorted(entry.name for entry in os.scandir(self.stateDirectory) if entry.is_dir() and not entry.name.startswith("."))
+        except FileNotFoundError:
+            systemIDs = []
+        for systemID in systemIDs:
+            self.getStore(systemID)
+        if self.defaultSystemID is not None and not self.readOnly and self.hasLegacyFiles():
+            # A configured default system may not have a directory yet
+            self.getStore(self.defaultSystemID)
+        return systemIDs
+
+    def getDirectoryMtime(self):
+        try:
+            return os.stat(self.stateDirectory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def findStore(self, systemID):
+        """Return the store of a known system, or None.  Unlike getStore(), never creates a system."""
+        store = self.stores.get(systemID)
+        if store is None and self.readOnly and os.path.isdir(os.path.join(self.stateDirectory, systemID)):
+            # Registered by the writing process since startup
+            store = self.getStore(systemID)
+        return store
+
+    def getStore(self, systemID):
+        """Return the store for a system, creating its state directory on first use.
+
+        Only requests from the thermostat itself should create systems, so that stray API requests do not.
+        """
+        store = self.stores.get(systemID)
+        if store is None:
+            systemDirectory = os.path.join(self.stateDirectory, systemID)
+            os.makedirs(systemDirectory, exist_ok=True)
+            sharedGenerations = None
+            if self.sharedFiles:
+                sharedGenerations = SharedGenerations(os.path.join(systemDirectory, FILE_GENERATIONS), self.sharedFiles)
+            store = StateStore(systemDirectory, writer=self.writer, systemID=systemID, onAccess=self.touch,
+                               sharedGenerations=sharedGenerations, readOnly=self.readOnly, epoch=self.epoch)
+            self.stores[systemID] = store
+            if self.defaultSystemID is None:
+                self.defaultSystemID = systemID
+            logger.info("Registered state for system '%s'", systemID)
+            if systemID == self.defaultSystemID and not self.readOnly:
+                self.migrateLegacyFiles(store)
+        return store
+
+    def hasLegacyFiles(self):
+        return any(os.path.exists(os.path.join(self.stateDirectory, fileName)) for fileName in self.legacyFiles)
+
+    def migrateLegacyFiles(self, store):
+        """Move state files left in the root of the state directory by earlier versions into the default system's directory."""
+        for fileName in self.legacyFiles:
+            legacyPath = os.path.join(self.stateDirectory, fileName)
+            if os.path.exists(legacyPath) and not os.path.exists(store.getPath(fileName)):
+                os.replace(legacyPath, store.getPath(fileName))
+                logger.warning("Moved '%s' into the state directory of system '%s'", legacyPath, store.systemID)
+
+    def getDefault(self):
+        """Return the store used by the API routes that do not name a system, if any system is known."""
+        if self.defaultSystemID is None and self.readOnly:
+            # Systems are registered by the writing process, so look for one it has created since startup
+            if self.discoveredMtime != self.getDirectoryMtime():
+                self.discover()
+        if self.defaultSystemID is None:
+            return None
+        return self.findStore(self.defaultSystemID) if self.readOnly else self.getStore(self.defaultSystemID)
+
+    async def close(self):
+        """Release the caches and open files of every store, once no more requests are served."""
+        closing = [store.clearCache() for store in self.stores.values()]
+        await asyncio.gather(*(future for future in closing if future is not None))
+
+    def touch(self, store):
+        """Mark a store as recently used, evicting the caches of the least recently used stores."""
+        if store.systemID in self.cachedStores:
+            self.cachedStores.move_to_end(store.systemID)
+            return
+        self.cachedStores[store.systemID] = store
+        for systemID in list(self.cachedStores):
+            if len(self.cachedStores) <= self.maxCachedSystems:
+                break
+            oldStore = self.cachedStores[systemID]
+            if oldStore.inflightWrites == 0:
+                del self.cachedStores[systemID]
+                oldStore.clearCache()
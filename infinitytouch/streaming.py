@@ -0,0 +1,59 @@
+import json
+import tornado.ioloop
+import tornado.iostream
+import tornado.websocket
+from .infinityproxy import BaseHandler
+
+
+class ChangeStreamHandler(BaseHandler):
+    """Stream status, config and notification changes to API clients as Server-Sent Events."""
+
+    requiresState = False
+
+    async def get(self, systemID=None):
+        self.subscription = self.changeBroker.subscribe(systemID or None)
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        try:
+            self.write(": connected\n\n")
+            await self.flush()
+            while True:
+                event = await self.subscription.get()
+                if event is None:
+                    break
+                self.write("event: {}\ndata: {}\n\n".format(event["source"], json.dumps(event)))
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.changeBroker.unsubscribe(self.subscription)
+
+    def on_connection_close(self):
+        subscription = getattr(self, "subscription", None)
+        if subscription is not None:
+            subscription.close()
+
+
+class ChangeSocketHandler(tornado.websocket.WebSocketHandler):
+    """Stream status, config and notification changes to API clients over a WebSocket."""
+
+    def open(self, systemID=None):
+        self.changeBroker = self.application.settings.get("changeBroker")
+        self.subscription = self.changeBroker.subscribe(systemID or None)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.sendChanges)
+
+    async def sendChanges(self):
+        while True:
+            event = await self.subscription.get()
+            if event is None:
+                return
+            try:
+                await self.write_message(json.dumps(event))
+            except tornado.websocket.WebSocketClosedError:
+                return
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.changeBroker.unsubscribe(self.subscription)
@@ -0,0 +1,76 @@
+import re
+import urllib.parse
+
+MAX_FIELD_NAME_LENGTH = 256
+
+fieldDelimiters = re.compile(b"[=&]")
+
+
+class FormFieldDecoder:
+    """Incrementally URL-decode the value of one field of an application/x-www-form-urlencoded body.
+
+    Chunks may end in the middle of a field name, a value or a percent escape.  Only an unfinished
+    escape or field name is carried over to the next chunk, so memory use does not grow with the body.
+    Like Tornado's own argument parsing, only the first occurrence of the field is decoded.
+    """
+
+    def __init__(self, fieldName):
+        self.fieldName = fieldName.encode()
+        self.name = b""
+        self.inValue = False
+        self.matched = False
+        self.found = False
+        self.pending = b""
+
+    def feed(self, chunk):
+        """Return the decoded bytes of the field's value that this chunk completes."""
+        data = self.pending + chunk
+        self.pending = b""
+        decoded = []
+        position = 0
+        while position < len(data):
+            if not self.inValue:
+                match = fieldDelimiters.search(data, position)
+                end = match.start() if match else len(data)
+                self.name = (self.name + data[position:end])[:MAX_FIELD_NAME_LENGTH]
+                if match is None:
+                    break
+                isField = not self.found and urllib.parse.unquote_to_bytes(self.name.replace(b"+", b" ")) == self.fieldName
+                self.name = b""
+                if match.group() == b"=":
+                    self.inValue = True
+                    self.matched = isField
+                elif isField:
+                    self.found = True
+                position = end + 1
+            else:
+                end = data.find(b"&", position)
+                if end < 0:
+                    end = len(data)
+                if self.matched:
+                    value = data[position:end]
+                    if end == len(data):
+                        # Hold back an escape that continues in the next chunk
+                        split = value.rfind(b"%", max(len(value) - 2, 0))
+                        if split >= 0:
+                            value, self.pending = value[:split], value[split:]
+                    decoded.append(urllib.parse.unquote_to_bytes(value.replace(b"+", b" ")))
+                if end == len(data):
+                    break
+                if self.matched:
+                    self.found = True
+                self.inValue = self.matched = False
+                position = end + 1
+        return b"".join(decoded)
+
+    def close(self):
+        """Decode whatever remains at the end of the body, returning it and whether the field was present."""
+        decoded = b""
+        if self.inValue and self.matched:
+            decoded = urllib.parse.unquote_to_bytes(self.pending.replace(b"+", b" "))
+            self.found = True
+        elif not self.inValue and self.name and not self.found:
+            self.found = urllib.parse.unquote_to_bytes(self.name.replace(b"+", b" ")) == self.fieldName
+        self.pending = b""
+        self.inValue = self.matched = False
+        return decoded, self.found
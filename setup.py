@@ -13,6 +13,11 @@ setup(
     long_description=long_description,
     long_description_content_type='text/markdown',
     packages=['infinitytouch'],
+    entry_points={
+        'console_scripts': [
+            'infinitytouch=infinitytouch.infinityproxy:main'
+        ]
+    },
     zip_safe=True,
     platforms='any',
     install_requires=list(val.strip() for val in open('requirements.txt')),
@@ -0,0 +1,90 @@
+import os
+import json
+import tempfile
+import unittest
+import urllib.parse
+from unittest import mock
+from tornado.testing import AsyncHTTPTestCase
+from infinitytouch.infinityproxy import createApp, acceptsGzip
+from infinitytouch.journal import recoverState
+from benchmarks.fixtures import SYSTEM_XML
+
+
+class SystemTestCase(AsyncHTTPTestCase):
+    """Serve a proxy with a fresh state directory that has a system.xml uploaded."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        AsyncHTTPTestCase.setUp(self)
+        response = self.fetch("/systems/SYS", method="POST", body=urllib.parse.urlencode({"data": SYSTEM_XML}))
+        self.assertEqual(response.code, 200)
+
+    def tearDown(self):
+        AsyncHTTPTestCase.tearDown(self)
+        self.directory.cleanup()
+
+    def get_app(self):
+        return createApp(stateDir=self.directory.name)
+
+
+class AcceptEncodingTest(SystemTestCase):
+
+    def test_accepts_gzip(self):
+        for header in ("gzip", "deflate, gzip", "GZip;q=0.5", "*", "br;q=1.0, *;q=0.1", "gzip;q=1, *;q=0", "x-gzip"):
+            self.assertTrue(acceptsGzip(header), header)
+        for header in ("", "identity", "deflate, br", "gzip;q=0", "gzip; q=0.0", "gzip;q=0, *", "*;q=0", "gzip;q=bad"):
+            self.assertFalse(acceptsGzip(header), header)
+
+    def test_response_encoding(self):
+        for header, encoding in (("gzip", "gzip"), ("gzip;q=0, deflate", None), ("*;q=0.5", "gzip")):
+            response = self.fetch("/api/SYS/config", headers={"Accept-Encoding": header}, decompress_response=False)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.headers.get("Content-Encoding"), encoding, header)
+
+
+class ConfigBatchTest(SystemTestCase):
+
+    def postBatch(self, edits):
+        return self.fetch("/api/SYS/config/batch", method="POST", body=json.dumps(edits))
+
+    def getSetpoint(self, zoneID, activityID="home"):
+        response = self.fetch("/api/SYS/config/zones/{}/activities/{}".format(zoneID, activityID))
+        return json.loads(response.body)["activity"]["htsp"]
+
+    def test_batch(self):
+        response = self.postBatch([{"path": "zones/1/activities/home/htsp", "value": "70.0"},
+                                   {"path": "/config/zones/2/activities/home/htsp", "value": "66.0"},
+                                   {"path": "mode", "value": "heat"}])
+        self.assertEqual(response.code, 200)
+        # Zone 2 already had that setpoint
+        self.assertEqual(json.loads(response.body), {"edits": 3, "changed": 2})
+        self.assertEqual(self.getSetpoint(1), "70.0")
+        self.assertEqual(json.loads(self.fetch("/api/SYS/changes").body)["pending"].keys(), {"config"})
+
+    def test_strict(self):
+        """A batch with any unknown element changes nothing."""
+        response = self.postBatch({"zones/1/activities/home/htsp": "70.0", "zones/1/activities/home/nosuchsetting": "1"})
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.getSetpoint(1), "66.0")
+
+    def test_invalid_body(self):
+        for body in ("not json", json.dumps([{"value": "70.0"}]), json.dumps({"nowhere/1": "70.0"})):
+            self.assertEqual(self.fetch("/api/SYS/config/batch", method="POST", body=body).code, 400, body)
+
+    def test_revert_when_save_fails(self):
+        """Edits that cannot be saved are undone in memory and in the journal, and answered with 500."""
+        store = self._app.settings["stateRegistry"].getStore("SYS")
+        with mock.patch.object(store.writer, "write", side_effect=OSError("No space left on device")):
+            response = self.postBatch({"zones/1/activities/home/htsp": "75.0", "zones/1/activities/home/clsp": "80.0"})
+        self.assertEqual(response.code, 500)
+        self.assertEqual(self.getSetpoint(1), "66.0")
+        self.assertEqual(json.loads(self.fetch("/api/SYS/changes").body)["pending"], {})
+
+        # Recovery after a restart must not apply the reverted edits either
+        systemDirectory = os.path.join(self.directory.name, "SYS")
+        os.utime(os.path.join(systemDirectory, "system.xml"), (0, 0))
+        journalDirectory = os.path.join(systemDirectory, "journal")
+        self.assertTrue(os.listdir(journalDirectory))
+        recoverState(systemDirectory, journalDirectory)
+        with open(os.path.join(systemDirectory, "system.xml"), "rb") as f:
+            self.assertEqual(f.read(), SYSTEM_XML)
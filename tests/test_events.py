@@ -0,0 +1,53 @@
+import xml.etree.ElementTree as ET
+import unittest
+from infinitytouch.events import ChangeBroker
+
+
+class ChangeBrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = ChangeBroker(queueSize=2)
+
+    def publish(self, *temperatures):
+        root = ET.fromstring("<status><mode>heat</mode><zones>{}</zones></status>".format(
+            "".join("<zone id='{}'><rt>{}</rt></zone>".format(zoneID, rt) for zoneID, rt in enumerate(temperatures, 1))))
+        self.broker.publishElement("SYS", "status", root)
+
+    def getEvents(self, subscription):
+        events = list(subscription.queue)
+        subscription.queue.clear()
+        return events
+
+    def test_snapshot_then_changes(self):
+        subscription = self.broker.subscribe("SYS")
+        self.publish("70.0", "68.0")
+        self.assertEqual(self.getEvents(subscription), [{
+            "source": "status", "type": "snapshot", "systemID": "SYS",
+            "values": {"mode": "heat", "zones/zone[@id='1']/rt": "70.0", "zones/zone[@id='2']/rt": "68.0"}}])
+        self.publish("71.0")
+        self.assertEqual(self.getEvents(subscription), [{
+            "source": "status", "type": "changes", "systemID": "SYS",
+            "changed": {"zones/zone[@id='1']/rt": "71.0"}, "removed": ["zones/zone[@id='2']/rt"]}])
+        self.publish("71.0")
+        self.assertEqual(self.getEvents(subscription), [])
+
+    def test_late_subscriber(self):
+        """A client subscribing after the first publish is sent a snapshot, while existing clients only see changes."""
+        first = self.broker.subscribe("SYS")
+        self.publish("70.0")
+        self.getEvents(first)
+        second = self.broker.subscribe(None)
+        self.publish("72.0")
+        self.assertEqual([event["type"] for event in self.getEvents(first)], ["changes"])
+        self.assertEqual([(event["type"], event["values"]["zones/zone[@id='1']/rt"]) for event in self.getEvents(second)],
+                         [("snapshot", "72.0")])
+
+    def test_snapshot_after_dropped_events(self):
+        subscription = self.broker.subscribe("SYS")
+        for rt in ("70.0", "71.0", "72.0"):
+            self.publish(rt)
+        # The snapshot was dropped from the full queue, so the next event starts over with a new one
+        self.assertEqual(subscription.dropped, 1)
+        self.assertEqual([event["type"] for event in subscription.queue], ["changes", "changes"])
+        self.publish("73.0")
+        self.assertEqual(subscription.queue[-1]["type"], "snapshot")
@@ -0,0 +1,81 @@
+import os
+import time
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from infinitytouch.journal import Journal, readJournal, recoverState, encodeEdits, getSegmentPath, RECORD_UPLOAD, RECORD_EDITS
+from benchmarks.fixtures import SYSTEM_XML, STATUS_XML
+
+
+class RecoverStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stateDirectory = self.directory.name
+        self.journalDirectory = os.path.join(self.stateDirectory, "journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def getJournal(self, **options):
+        # Records are written synchronously here, so the journal needs no writer
+        return Journal(self.journalDirectory, None, **options)
+
+    def writeStateFile(self, fileName, data, mtime):
+        filePath = os.path.join(self.stateDirectory, fileName)
+        with open(filePath, "wb") as f:
+            f.write(data)
+        os.utime(filePath, (mtime, mtime))
+
+    def readStateFile(self, fileName):
+        with open(os.path.join(self.stateDirectory, fileName), "rb") as f:
+            return f.read()
+
+    def test_corrupted_file(self):
+        """A state file that is not well-formed XML is replaced by its last journaled upload, however recent the file is."""
+        journal = self.getJournal()
+        journal.writeData(RECORD_UPLOAD, "system.xml", SYSTEM_XML, time.time() - 60)
+        journal.closeSegment()
+        self.writeStateFile("system.xml", SYSTEM_XML[:len(SYSTEM_XML) // 2], time.time())
+
+        self.assertEqual(recoverState(self.stateDirectory, self.journalDirectory), ["system.xml"])
+        self.assertEqual(self.readStateFile("system.xml"), SYSTEM_XML)
+
+    def test_intact_file_is_kept(self):
+        journal = self.getJournal()
+        journal.writeData(RECORD_UPLOAD, "status.xml", STATUS_XML, time.time() - 60)
+        journal.closeSegment()
+        self.writeStateFile("status.xml", b"<status>newer</status>", time.time())
+
+        self.assertEqual(recoverState(self.stateDirectory, self.journalDirectory), [])
+        self.assertEqual(self.readStateFile("status.xml"), b"<status>newer</status>")
+
+    def test_torn_last_record(self):
+        """A record cut short by a crash is ignored, and the file is recovered from the record before it."""
+        journal = self.getJournal()
+        journal.writeData(RECORD_UPLOAD, "status.xml", b"<status>first</status>", time.time())
+        journal.writeData(RECORD_UPLOAD, "status.xml", STATUS_XML, time.time())
+        journal.closeSegment()
+        segmentPath = getSegmentPath(self.journalDirectory, 1)
+        os.truncate(segmentPath, os.path.getsize(segmentPath) - 10)
+
+        self.assertEqual([record.body for record in readJournal(self.journalDirectory)], [b"<status>first</status>"])
+        self.assertEqual(recoverState(self.stateDirectory, self.journalDirectory), ["status.xml"])
+        self.assertEqual(self.readStateFile("status.xml"), b"<status>first</status>")
+
+    def test_edits_on_pruned_upload(self):
+        """Once the last upload of system.xml has been pruned, journaled edits are applied to the file on disk."""
+        # Every record gets its own segment, and the journal only has room for the newest one
+        journal = self.getJournal(maxSize=1, segmentSize=1)
+        journal.writeData(RECORD_UPLOAD, "system.xml", SYSTEM_XML, time.time() - 60)
+        edits = [(("ZoneActivity", "1", "home"), "/htsp", "71.0"), (("Config",), "/mode", "heat")]
+        journal.writeData(RECORD_EDITS, "system.xml", encodeEdits(edits), time.time())
+        journal.closeSegment()
+        self.assertEqual([record.kind for record in readJournal(self.journalDirectory)], [RECORD_EDITS])
+        self.writeStateFile("system.xml", SYSTEM_XML, time.time() - 30)
+
+        self.assertEqual(recoverState(self.stateDirectory, self.journalDirectory), ["system.xml"])
+        root = ET.fromstring(self.readStateFile("system.xml"))
+        self.assertEqual(root.find("./config/zones/zone[@id='1']/activities/activity[@id='home']/htsp").text, "71.0")
+        self.assertEqual(root.find("./config/zones/zone[@id='2']/activities/activity[@id='home']/htsp").text, "66.0")
+        self.assertEqual(root.find("./config/mode").text, "heat")
@@ -0,0 +1,121 @@
+import os
+import asyncio
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+import xmltodict
+from tornado.testing import AsyncTestCase, gen_test
+from infinitytouch.changes import ChangeTracker
+from infinitytouch.state import StateStore, StateRegistry, elementToDict, formatOutgoingXml
+from benchmarks.fixtures import SYSTEM_XML, STATUS_XML, NOTIFICATION_XML, HISTORY_XML
+
+
+class StagedWriteTest(AsyncTestCase):
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = StateStore(self.directory.name)
+        with open(self.store.getPath("system.xml"), "wb") as f:
+            f.write(b"<system>old</system>")
+
+    def tearDown(self):
+        self.directory.cleanup()
+        AsyncTestCase.tearDown(self)
+
+    @gen_test
+    async def test_read_during_staged_write(self):
+        """A file read while a staged upload is being renamed into place must not cache the old contents."""
+        await self.store.getRoot("system.xml")
+        stagedFile = self.store.stageFile("system.xml")
+        await self.store.writer.run(stagedFile.write, b"<system>new</system>")
+        write = asyncio.ensure_future(self.store.write("system.xml", stagedFile))
+        await asyncio.sleep(0)
+        root = await self.store.getRoot("system.xml")
+        await write
+        self.assertEqual(root.text, "new")
+        self.assertEqual((await self.store.getRoot("system.xml")).text, "new")
+
+
+class ChangeTrackerTest(AsyncTestCase):
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = StateStore(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        AsyncTestCase.tearDown(self)
+
+    @gen_test
+    async def test_malformed_entries(self):
+        """Entries with an invalid queue time are skipped, and the rest of the file is still loaded."""
+        filePath = self.store.getPath("changes")
+        with open(filePath, "w") as f:
+            f.write('{"config": "soon", "dealer": null, "idu": [1], "odu": "1700000000.5", "unknown": 1}')
+        changes = ChangeTracker(filePath, self.store.writer)
+        with self.assertLogs("InfinityProxy", "WARNING") as logs:
+            await changes.load()
+        self.assertEqual(len(logs.output), 3)
+        self.assertEqual(changes.queued, {"odu": 1700000000.5})
+        self.assertFalse(changes.isChanged("config"))
+
+
+class SharedGenerationsTest(AsyncTestCase):
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        AsyncTestCase.tearDown(self)
+
+    def startProcesses(self):
+        """Return the stores of the writing process and of an API worker, as created after a restart."""
+        epoch = os.urandom(4).hex()
+        writer = StateRegistry(self.directory.name, sharedFiles=("system.xml",), epoch=epoch).getStore("SYS")
+        reader = StateRegistry(self.directory.name, sharedFiles=("system.xml",), readOnly=True, epoch=epoch).findStore("SYS")
+        return writer, reader
+
+    async def assertSameETag(self, writer, reader):
+        await writer.getEntry("system.xml")
+        await reader.getEntry("system.xml")
+        self.assertEqual(writer.getETag("system.xml"), reader.getETag("system.xml"))
+
+    @gen_test
+    async def test_etags_match_after_restart(self):
+        """The writer and API workers must hand out the same entity tag for a file, also after the writer restarts."""
+        writer, reader = self.startProcesses()
+        await writer.write("system.xml", b"<system>1</system>")
+        await writer.write("system.xml", b"<system>2</system>")
+        await self.assertSameETag(writer, reader)
+
+        writer, reader = self.startProcesses()
+        await self.assertSameETag(writer, reader)
+        await writer.write("system.xml", b"<system>3</system>")
+        await self.assertSameETag(writer, reader)
+
+
+class ElementToDictTest(unittest.TestCase):
+
+    def assertSameAsXmltodict(self, element):
+        self.assertEqual(elementToDict(element), xmltodict.parse(formatOutgoingXml(element)), formatOutgoingXml(element)[:200])
+
+    def test_fixtures(self):
+        """Every element of the fixture payloads converts like xmltodict does, from the root down to single values."""
+        for data in (SYSTEM_XML, STATUS_XML, NOTIFICATION_XML, HISTORY_XML):
+            for element in ET.fromstring(data).iter():
+                self.assertSameAsXmltodict(element)
+
+    def test_indented(self):
+        root = ET.fromstring(SYSTEM_XML)
+        ET.indent(root)
+        self.assertSameAsXmltodict(root)
+
+    def test_attributes_and_mixed_content(self):
+        for data in (b'<zone id=" 1 " name="a\tb"><name>Main</name>text<hold/>tail</zone>',
+                     b"<list><item>1</item><item/><item> padded </item><other>x</other><item>3</item></list>",
+                     b'<a xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self"/></a>'):
+            self.assertSameAsXmltodict(ET.fromstring(data))
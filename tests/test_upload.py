@@ -0,0 +1,62 @@
+import random
+import unittest
+import urllib.parse
+import tornado.httputil
+from infinitytouch.upload import FormFieldDecoder
+from benchmarks.fixtures import SYSTEM_XML, STATUS_XML
+
+FORM_TYPE = "application/x-www-form-urlencoded"
+
+
+def decodeInChunks(body, splits):
+    decoder = FormFieldDecoder("data")
+    decoded = []
+    position = 0
+    for split in sorted(splits) + [len(body)]:
+        decoded.append(decoder.feed(body[position:split]))
+        position = split
+    remainder, found = decoder.close()
+    return b"".join(decoded) + remainder, found
+
+
+class FormFieldDecoderTest(unittest.TestCase):
+
+    bodies = [
+        urllib.parse.urlencode({"data": SYSTEM_XML}).encode(),
+        urllib.parse.urlencode({"other": "a&b=c", "data": STATUS_XML, "more": "x"}).encode(),
+        urllib.parse.urlencode({"data": "café 100% + more & more=less"}).encode(),
+        urllib.parse.urlencode([("data", "first"), ("data", "second")]).encode(),
+        urllib.parse.urlencode([("d%61ta", "escaped name")]).encode(),
+        b"data=",
+        b"data",
+        b"other=1&data",
+        b"other=1",
+        b"",
+        b"data=%zz%4",
+        b"data=%",
+        b"da+ta=spaced&data=plain+value%2B",
+    ]
+
+    def assertMatchesTornado(self, body, splits):
+        arguments = {}
+        tornado.httputil.parse_body_arguments(FORM_TYPE, body, arguments, {})
+        expected = arguments["data"][0] if "data" in arguments else b""
+        self.assertEqual(decodeInChunks(body, splits), (expected, "data" in arguments), "body %r split at %r" % (body[:80], splits))
+
+    def test_whole_body(self):
+        for body in self.bodies:
+            self.assertMatchesTornado(body, [])
+
+    def test_every_single_split(self):
+        for body in self.bodies:
+            if len(body) > 200:
+                continue
+            for split in range(len(body) + 1):
+                self.assertMatchesTornado(body, [split])
+
+    def test_random_splits(self):
+        generator = random.Random(20)
+        for body in self.bodies:
+            for _ in range(50):
+                splits = [generator.randint(0, len(body)) for _ in range(generator.randint(1, 40))]
+                self.assertMatchesTornado(body, splits)